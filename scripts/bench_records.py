@@ -0,0 +1,145 @@
+import gc
+import sys
+import json
+import time
+import random
+import argparse
+import tracemalloc
+from records import RecordStore
+
+# レコード層のメモリベンチマーク
+# 合成したデータベースを、JSONのdictのまま保持した場合とレコードに変換した場合で比較する
+
+SAMPLE_CONTENTS = [
+    'ラインで自動で申請書を記入できるアプリをつくりたい',
+    '犯罪発生予測マップをつくりたい',
+    '寝る前に思いついたことを整理してくれるサービス',
+    '地域の空き家を活用したコワーキングスペース',
+]
+
+# 合成データベースのJSON文字列を生成
+def generate_database_json(idea_count, user_count, seed=0):
+    rng = random.Random(seed)
+    user_ids = [f"U{rng.getrandbits(128):032x}" for _ in range(user_count)]
+    database = {
+        'users': {user_id: {'created_at': '2025-04-06T11:54:05.972Z'} for user_id in user_ids},
+        'ideas': {},
+        'results': {}
+    }
+    for i in range(idea_count):
+        idea_id = f"idea_20250406_{i:06d}"
+        processed = rng.random() < 0.9
+        database['ideas'][idea_id] = {
+            'user_id': rng.choice(user_ids),
+            'content': f"{rng.choice(SAMPLE_CONTENTS)} #{i}",
+            'created_at': f"2025-04-06T{i // 3600 % 24:02d}:{i // 60 % 60:02d}:{i % 60:02d}.{i % 1000:03d}Z",
+            'processed': processed
+        }
+        if processed:
+            database['results'][f"result_{idea_id[5:]}"] = {
+                'idea_id': idea_id,
+                'enhanced_content': f"ブラッシュアップ #{i}",
+                'mindmap_content': f"* アイデア #{i}",
+                'created_at': f"2025-04-06T21:{i // 60 % 60:02d}:{i % 60:02d}.{i % 1000000:06d}",
+                'sent': rng.random() < 0.9
+            }
+    return json.dumps(database, ensure_ascii=False)
+
+# 本文・IDなど、どちらの形式でも保持する文字列のサイズ
+def text_payload_bytes(store):
+    total = 0
+    for _, idea in store.ideas.scan():
+        total += sys.getsizeof(idea.idea_id) + sys.getsizeof(idea.content)
+    for _, result in store.results.scan():
+        total += (
+            sys.getsizeof(result.result_id)
+            + sys.getsizeof(result.enhanced_content)
+            + sys.getsizeof(result.mindmap_content)
+        )
+    return total
+
+# 関数の実行結果が保持しているメモリと、実行中のピークのメモリを計測
+def measure(build):
+    gc.collect()
+    tracemalloc.start()
+    value = build()
+    gc.collect()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return value, current, peak
+
+# 関数の実行時間を計測（tracemallocは処理を大きく遅くするため、メモリとは別に計測する）
+def timed(build):
+    gc.collect()
+    start = time.perf_counter()
+    value = build()
+    return value, time.perf_counter() - start
+
+# 保存用のdictに戻す間のピークのメモリを計測（レコードと保存用のdictが同時に存在する）
+def measure_dump(store):
+    gc.collect()
+    tracemalloc.start()
+    database = store.to_dict()
+    _, peak = tracemalloc.get_traced_memory()
+    del database
+    tracemalloc.stop()
+    return peak
+
+def main():
+    parser = argparse.ArgumentParser(description='レコード層のメモリベンチマーク')
+    parser.add_argument('--ideas', type=int, default=1_000_000, help='合成するアイデアの件数')
+    parser.add_argument('--users', type=int, default=1000, help='合成するユーザーの人数')
+    parser.add_argument('--min-ratio', type=float, default=3.0,
+                        help='本文以外の構造部分のメモリ削減率の下限（下回ると失敗）')
+    parser.add_argument('--max-peak-ratio', type=float, default=1.0,
+                        help='読み込み時のピークのメモリの、dictのまま読み込んだ場合に対する比率の上限（上回ると失敗）')
+    args = parser.parse_args()
+
+    print(f"Generating synthetic database: {args.ideas} ideas, {args.users} users")
+    text = generate_database_json(args.ideas, args.users)
+
+    # JSONのdictのまま保持した場合
+    database, dict_bytes, dict_peak = measure(lambda: json.loads(text))
+    record_count = len(database['ideas']) + len(database['results'])
+    del database
+    database, dict_seconds = timed(lambda: json.loads(text))
+    del database
+
+    # レコードに変換した場合（JSONの解析中に列へ追加し、元のdictは保持しない）
+    load_records = lambda: RecordStore.from_json(text)
+    store, record_bytes, record_peak = measure(load_records)
+    del store
+    store, record_seconds = timed(load_records)
+
+    # 保存用のdictに戻す時間とピーク（保持しているレコードの分は含まない）
+    dump_peak = measure_dump(store)
+    _, dump_seconds = timed(store.to_dict)
+
+    # 本文やIDの文字列はどちらの形式でも同じだけ必要になるため、それ以外の構造部分も比較する
+    payload_bytes = text_payload_bytes(store)
+    dict_overhead = dict_bytes - payload_bytes
+    record_overhead = record_bytes - payload_bytes
+
+    ratio = dict_bytes / record_bytes if record_bytes else 0
+    overhead_ratio = dict_overhead / record_overhead if record_overhead > 0 else 0
+    print(f"Records: {record_count} (text payload {payload_bytes / record_count:.1f} bytes/record)")
+    print(f"dict:    {dict_bytes / record_count:.1f} bytes/record, overhead {dict_overhead / record_count:.1f} bytes/record ({dict_bytes / 1024 / 1024:.1f} MiB, load {dict_seconds:.2f}s)")
+    print(f"records: {record_bytes / record_count:.1f} bytes/record, overhead {record_overhead / record_count:.1f} bytes/record ({record_bytes / 1024 / 1024:.1f} MiB, load {record_seconds:.2f}s, dump {dump_seconds:.2f}s)")
+    print(f"Reduction: {ratio:.2f}x total, {overhead_ratio:.2f}x overhead")
+    print(f"Peak:    dict load {dict_peak / 1024 / 1024:.1f} MiB, records load {record_peak / 1024 / 1024:.1f} MiB, "
+          f"records dump {(record_bytes + dump_peak) / 1024 / 1024:.1f} MiB")
+
+    failed = False
+    if overhead_ratio < args.min_ratio:
+        print(f"Overhead reduction {overhead_ratio:.2f}x is below --min-ratio {args.min_ratio}")
+        failed = True
+    if record_peak > dict_peak * args.max_peak_ratio:
+        print(f"Load peak {record_peak / dict_peak:.2f}x of dict is above --max-peak-ratio {args.max_peak_ratio}")
+        failed = True
+    if failed:
+        print("Record benchmark failed")
+        sys.exit(1)
+    print("Record benchmark passed")
+
+if __name__ == "__main__":
+    main()
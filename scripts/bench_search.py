@@ -0,0 +1,98 @@
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+from records import Idea, Result, RecordStore
+from search_index import SearchIndex
+
+# 全文検索インデックスのベンチマーク
+# 合成したアイデア・結果でインデックスを作成し、差分の反映時間と検索時間を計測する
+
+SAMPLE_PHRASES = [
+    'ラインで自動で申請書を記入できるアプリ',
+    '犯罪発生予測マップ',
+    '寝る前に思いついたことを整理してくれるサービス',
+    '地域の空き家を活用したコワーキングスペース',
+    '子どもの送り迎えを近所で分担する仕組み',
+    'AIで家計簿を自動でつけるツール',
+    '旅行の持ち物をチェックリストにするLINEボット',
+    '地元の農家と飲食店をつなぐマーケット',
+]
+
+SAMPLE_ENHANCEMENTS = [
+    'ターゲットユーザーを明確にし、最初は小さな地域で検証します。',
+    '収益モデルとしてはサブスクリプションと広告の組み合わせが考えられます。',
+    '既存のサービスとの違いは、入力の手間がほとんどかからない点です。',
+    'データの取り扱いについてはプライバシーへの配慮が必要です。',
+    'MVPではLINEのリッチメニューから主要な機能を呼び出せるようにします。',
+]
+
+QUERIES = ['アプリ', '犯罪 予測', '空き家', 'line', 'ai', 'サブスクリプション', '地域', '存在しない語句']
+
+# 合成したアイデア・結果を追加
+def add_synthetic_ideas(store, start, count, user_ids, rng):
+    for i in range(start, start + count):
+        idea_id = f"idea_20250406_{i:06d}"
+        content = f"{rng.choice(SAMPLE_PHRASES)}を{rng.choice(['つくりたい', '考えた', '試したい'])} #{i}"
+        idea = Idea(idea_id=idea_id, user_id=rng.choice(user_ids), content=content, created_at=i, processed=True)
+        enhanced = '\n'.join(rng.sample(SAMPLE_ENHANCEMENTS, 3))
+        result = Result(result_id=f"result_{idea_id[5:]}", idea_id=idea_id, enhanced_content=enhanced,
+                        mindmap_content='', created_at=i)
+        store.ideas[idea_id] = idea
+        store.results[result.result_id] = result
+
+def percentile(values, ratio):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * ratio))]
+
+def main():
+    parser = argparse.ArgumentParser(description='全文検索インデックスのベンチマーク')
+    parser.add_argument('--ideas', type=int, default=100_000, help='合成するアイデアの件数')
+    parser.add_argument('--users', type=int, default=1000, help='合成するユーザーの人数')
+    parser.add_argument('--nightly', type=int, default=1000, help='夜間処理1回分として追加するアイデアの件数')
+    parser.add_argument('--max-query-ms', type=float, default=50,
+                        help='ユーザーを指定した検索の95パーセンタイルの上限（超えると失敗）')
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    user_ids = [f"U{rng.getrandbits(128):032x}" for _ in range(args.users)]
+    store = RecordStore()
+    add_synthetic_ideas(store, 0, args.ideas, user_ids, rng)
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'search_index.sqlite3')
+        with SearchIndex(path) as index:
+            # 初回の作成
+            start = time.perf_counter()
+            index.sync(store)
+            build_seconds = time.perf_counter() - start
+            print(f"Built index of {args.ideas} ideas in {build_seconds:.1f}s ({os.path.getsize(path) / 1024 / 1024:.1f} MiB)")
+
+            # 夜間処理1回分の差分の反映
+            add_synthetic_ideas(store, args.ideas, args.nightly, user_ids, rng)
+            start = time.perf_counter()
+            count = index.sync(store)
+            print(f"Synced {count} new ideas in {time.perf_counter() - start:.2f}s")
+
+            # 検索時間
+            failed = False
+            for label, user_id in (('all users', None), ('single user', user_ids[0])):
+                timings = []
+                for query in QUERIES * 5:
+                    start = time.perf_counter()
+                    index.search(query, user_id=user_id)
+                    timings.append((time.perf_counter() - start) * 1000)
+                p50 = percentile(timings, 0.5)
+                p95 = percentile(timings, 0.95)
+                print(f"Search ({label}): p50 {p50:.2f} ms, p95 {p95:.2f} ms")
+                if user_id is not None and p95 > args.max_query_ms:
+                    failed = True
+
+    if failed:
+        print("Search benchmark failed")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+# 起動時間ベンチマーク
+# エントリーポイントの読み込み時に重いモジュールがインポートされていないこと、
+# 処理対象がない場合に即座に終了することを確認する
+
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# エントリーポイントのモジュール名
+ENTRY_MODULES = [
+    'process_ideas',
+    'process_ideas_local',
+    'send_notifications',
+    'send_notifications_local',
+]
+
+# 読み込み時にインポートしてはいけないモジュール
+HEAVY_MODULES = ['openai', 'requests', 'dotenv', 'aiohttp', 'urllib3']
+
+# 処理対象がない場合のスクリプトと期待される出力
+# GitHub Actionsのスクリプトは、チェックアウト済みのデータベースで処理対象がないことを確認し、GitHub APIを呼び出さずに終了する
+NO_WORK_SCRIPTS = [
+    ('process_ideas.py', 'No unprocessed ideas found'),
+    ('process_ideas_local.py', 'No unprocessed ideas found'),
+    ('send_notifications.py', 'No unsent results found'),
+    ('send_notifications_local.py', 'No unsent results found'),
+]
+
+# -X importtime の出力を解析して (モジュール名, 累積マイクロ秒) のリストを返す
+def parse_importtime(stderr):
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        parts = line[len('import time:'):].split('|')
+        if len(parts) != 3 or not parts[1].strip().isdigit():
+            continue
+        imports.append((parts[2].strip(), int(parts[1].strip())))
+    return imports
+
+# モジュールのインポート時間を計測
+def measure_import(module_name):
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module_name}'],
+        cwd=SCRIPTS_DIR,
+        capture_output=True,
+        text=True
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"Failed to import {module_name}: {result.stderr}")
+
+    imports = parse_importtime(result.stderr)
+    cumulative_us = next((us for name, us in imports if name == module_name), 0)
+    heavy = sorted({
+        name for name, _ in imports
+        if name.split('.')[0] in HEAVY_MODULES
+    })
+    return cumulative_us, heavy
+
+# 処理対象がない場合の実行時間を計測
+def measure_no_work(script_name, expected_output):
+    with open(os.path.join(SCRIPTS_DIR, '..', 'data', 'database.json'), 'r', encoding='utf-8') as f:
+        database = json.load(f)
+
+    # すべて処理済み・送信済みのデータベースを用意する
+    for idea_data in database.get('ideas', {}).values():
+        idea_data['processed'] = True
+    for result_data in database.get('results', {}).values():
+        result_data['sent'] = True
+
+    work_dir = tempfile.mkdtemp()
+    try:
+        os.makedirs(os.path.join(work_dir, 'data'))
+        with open(os.path.join(work_dir, 'data', 'database.json'), 'w', encoding='utf-8') as f:
+            json.dump(database, f, ensure_ascii=False)
+
+        start = time.perf_counter()
+        result = subprocess.run(
+            [sys.executable, os.path.join(SCRIPTS_DIR, script_name)],
+            cwd=work_dir,
+            capture_output=True,
+            text=True
+        )
+        elapsed_ms = (time.perf_counter() - start) * 1000
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    if result.returncode != 0 or expected_output not in result.stdout:
+        raise RuntimeError(f"Unexpected output from {script_name}: {result.stdout}{result.stderr}")
+    return elapsed_ms
+
+def main():
+    parser = argparse.ArgumentParser(description='エントリーポイントの起動時間ベンチマーク')
+    parser.add_argument('--max-import-ms', type=float, default=50.0,
+                        help='モジュール読み込み時間の上限（ミリ秒）')
+    parser.add_argument('--max-no-work-ms', type=float, default=500.0,
+                        help='処理対象がない場合の実行時間の上限（インタプリタ起動を含む、ミリ秒）')
+    args = parser.parse_args()
+
+    failed = False
+
+    print("Import time:")
+    for module_name in ENTRY_MODULES:
+        cumulative_us, heavy = measure_import(module_name)
+        status = 'OK'
+        if heavy:
+            status = f"NG (heavy imports: {', '.join(heavy)})"
+            failed = True
+        elif cumulative_us / 1000 > args.max_import_ms:
+            status = 'NG (too slow)'
+            failed = True
+        print(f"  {module_name}: {cumulative_us / 1000:.1f} ms {status}")
+
+    print("No-work path:")
+    for script_name, expected_output in NO_WORK_SCRIPTS:
+        elapsed_ms = measure_no_work(script_name, expected_output)
+        status = 'OK'
+        if elapsed_ms > args.max_no_work_ms:
+            status = 'NG (too slow)'
+            failed = True
+        print(f"  {script_name}: {elapsed_ms:.1f} ms {status}")
+
+    if failed:
+        print("Startup benchmark failed")
+        sys.exit(1)
+    print("Startup benchmark passed")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+import os
+import re
+from dataclasses import dataclass, field
+
+# 安価なモデルを先に使うカスケード
+# ブラッシュアップ・マインドマップはまず安価なモデルで生成し、ローカルの検証（長さ・構成・マインドマップとして解析できるか）に
+# 通らなかった場合だけ通常のモデルで作り直す。複雑なアイデアは最初から通常のモデルで生成する
+
+# カスケードを使うか（環境変数 MODEL_CASCADE=0 で無効）
+CASCADE_ENABLED = os.environ.get('MODEL_CASCADE', '').lower() not in ('0', 'false', 'no')
+
+# 最初から通常のモデルで生成する複雑なアイデアの条件（文字数・行数）
+COMPLEX_IDEA_LENGTH = 200
+COMPLEX_IDEA_LINES = 3
+
+# ブラッシュアップの検証条件（文字数・空行以外の行数）
+MIN_ENHANCEMENT_LENGTH = 200
+MIN_ENHANCEMENT_LINES = 2
+
+# マインドマップの検証条件（項目数）
+MIN_MINDMAP_NODES = 5
+
+# 生成に失敗した場合の応答（enhance_idea・generate_mindmapがエラー時に返す文言）
+ERROR_PREFIXES = ('アイデアの処理中にエラーが発生しました', 'マインドマップの生成中にエラーが発生しました')
+
+# マインドマップの項目に含まれるとMermaidの記法が壊れる文字
+# サーバーは中心の項目を root((内容))、それ以外を id[内容] に変換する
+MERMAID_UNSAFE_ROOT_PATTERN = re.compile(r'[()\[\]]')
+MERMAID_UNSAFE_NODE_PATTERN = re.compile(r'[\[\]]')
+
+# マインドマップの行（インデント・記号・内容）。サーバーのconvertTextMindmapToMermaidと同じ解釈
+MINDMAP_LINE_PATTERN = re.compile(r'^(\s*)[*\-+]?\s*(.*)')
+
+# 生成の経路
+ROUTE_CHEAP_FIRST = 'cheap_first'  # 安価なモデルの生成が検証に通った
+ROUTE_ESCALATED = 'escalated'      # 検証に通らず通常のモデルで作り直した
+ROUTE_COMPLEX = 'complex'          # 複雑なアイデアのため最初から通常のモデルで生成した
+
+# 複雑なアイデアか
+def is_complex_idea(content):
+    lines = [line for line in content.splitlines() if line.strip()]
+    return len(content) >= COMPLEX_IDEA_LENGTH or len(lines) >= COMPLEX_IDEA_LINES
+
+# カスケードの経路を決める（カスケードを使わない場合はNone）
+# 予算の都合で安価なモデルに切り替えられたアイデアは、作り直さずにそのまま使う
+def cascade_route(content, decision, primary_model, cheap_model):
+    if not CASCADE_ENABLED or decision.model != primary_model or cheap_model == primary_model:
+        return None
+    if is_complex_idea(content):
+        return ROUTE_COMPLEX
+    return ROUTE_CHEAP_FIRST
+
+# ブラッシュアップを検証（問題がなければNone、あれば理由を返す）
+def validate_enhancement(text):
+    text = (text or '').strip()
+    if not text or text.startswith(ERROR_PREFIXES):
+        return 'generation failed'
+    if len(text) < MIN_ENHANCEMENT_LENGTH:
+        return f"too short ({len(text)} < {MIN_ENHANCEMENT_LENGTH} chars)"
+    lines = [line for line in text.splitlines() if line.strip()]
+    if len(lines) < MIN_ENHANCEMENT_LINES:
+        return f"not structured ({len(lines)} < {MIN_ENHANCEMENT_LINES} lines)"
+    return None
+
+# マインドマップを検証（問題がなければNone、あれば理由を返す）
+# サーバーと同じくインデント2文字を1階層として解釈し、画像に変換できる形かを確認する
+def validate_mindmap(text):
+    text = (text or '').replace('```', '').strip('\n')
+    if not text.strip() or text.strip().startswith(ERROR_PREFIXES):
+        return 'generation failed'
+
+    nodes = 0
+    roots = 0
+    depth = 0
+    levels = set()
+    for line in text.splitlines():
+        match = MINDMAP_LINE_PATTERN.match(line)
+        content = match.group(2).strip()
+        if not content:
+            continue
+        level = len(match.group(1)) // 2
+        if level == 0:
+            roots += 1
+            levels = {0}
+        elif level - 1 not in levels:
+            # 親のない項目はサーバーで無視される
+            return f"orphan node at depth {level}: {content[:20]}"
+        else:
+            levels = {other for other in levels if other < level} | {level}
+        unsafe_pattern = MERMAID_UNSAFE_ROOT_PATTERN if level == 0 else MERMAID_UNSAFE_NODE_PATTERN
+        if unsafe_pattern.search(content):
+            return f"unsafe characters in node: {content[:20]}"
+        nodes += 1
+        depth = max(depth, level)
+
+    if roots != 1:
+        return f"expected one root node, found {roots}"
+    if nodes < MIN_MINDMAP_NODES:
+        return f"too few nodes ({nodes} < {MIN_MINDMAP_NODES})"
+    if depth < 1:
+        return 'no child nodes'
+    return None
+
+VALIDATORS = {
+    'enhance': validate_enhancement,
+    'mindmap': validate_mindmap,
+}
+
+# 1回の実行のカスケードの記録（作り直しの割合・安価なモデルによる処理時間の削減）
+@dataclass
+class CascadeStats:
+    kinds: dict = field(default_factory=dict)
+
+    # 生成の経路を記録
+    # 削減時間は、通常のモデルの見積もり時間から安価なモデルの実際の時間を引いたもの
+    # 作り直した場合は、安価なモデルにかかった時間がそのまま増えた時間になる
+    def record(self, kind, route, cheap_seconds=0.0, primary_seconds=0.0, reason=None):
+        stats = self.kinds.setdefault(kind, {
+            ROUTE_CHEAP_FIRST: 0, ROUTE_ESCALATED: 0, ROUTE_COMPLEX: 0,
+            'saved_seconds': 0.0, 'reasons': {}
+        })
+        stats[route] += 1
+        if route == ROUTE_CHEAP_FIRST:
+            stats['saved_seconds'] += primary_seconds - cheap_seconds
+        elif route == ROUTE_ESCALATED:
+            stats['saved_seconds'] -= cheap_seconds
+            # 理由は数値を除いて集計する
+            key = re.sub(r'\s*\(.*\)|:.*', '', reason or '')
+            stats['reasons'][key] = stats['reasons'].get(key, 0) + 1
+
+    # 作り直しの割合（安価なモデルで生成した件数のうち）
+    @staticmethod
+    def escalation_rate(stats):
+        tried = stats[ROUTE_CHEAP_FIRST] + stats[ROUTE_ESCALATED]
+        return stats[ROUTE_ESCALATED] / tried if tried else 0.0
+
+    # 複雑なアイデアとして最初から通常のモデルで生成した割合
+    @staticmethod
+    def complex_share(stats):
+        total = stats[ROUTE_CHEAP_FIRST] + stats[ROUTE_ESCALATED] + stats[ROUTE_COMPLEX]
+        return stats[ROUTE_COMPLEX] / total if total else 0.0
+
+    # 実行記録として保存する形式
+    def run_metrics(self):
+        return {
+            kind: {
+                'accepted': stats[ROUTE_CHEAP_FIRST],
+                'escalated': stats[ROUTE_ESCALATED],
+                'complex': stats[ROUTE_COMPLEX],
+                'complex_share': round(self.complex_share(stats), 3),
+                'escalation_rate': round(self.escalation_rate(stats), 3),
+                'saved_seconds': round(stats['saved_seconds'], 1),
+                'reasons': stats['reasons']
+            }
+            for kind, stats in self.kinds.items()
+        }
@@ -0,0 +1,144 @@
+import os
+import json
+import uuid
+import hashlib
+from datetime import datetime
+from line_messages import pack_messages
+
+# 配信ログ
+# 結果ごと・メッセージごとに送信済みかを記録し、プッシュが成功するたびに追記して保存する
+# 途中で失敗・中断した場合も、再実行時は未送信のメッセージだけを送信する
+
+# 配信ログのファイルパス
+DELIVERY_LOG_PATH = os.environ.get('DELIVERY_LOG_PATH', 'data/delivery_log.jsonl')
+
+# リトライキー（X-Line-Retry-Key）を生成するための名前空間
+RETRY_KEY_NAMESPACE = uuid.UUID('6f1c7a52-3b0e-4d8e-9a51-0c2f7e4b8d13')
+
+# マインドマップ画像のキー（生成済み画像の送信・サーバーのAPI経由の送信で共通）
+MINDMAP_IMAGE_PART = 'mindmap_image'
+
+# メッセージのキー（種類＋内容のハッシュ、同じ内容のメッセージには連番を付ける）
+def message_part_keys(messages):
+    keys = []
+    counts = {}
+    for message in messages:
+        payload = json.dumps(message, ensure_ascii=False, sort_keys=True)
+        digest = hashlib.sha256(payload.encode('utf-8')).hexdigest()[:16]
+        key = f"{message.get('type', 'message')}:{digest}"
+        counts[key] = counts.get(key, 0) + 1
+        if counts[key] > 1:
+            key = f"{key}:{counts[key]}"
+        keys.append(key)
+    return keys
+
+# リトライキーを生成
+# 同じ結果・同じメッセージの組み合わせには常に同じキーを使うため、
+# 送信後に記録する前に中断した場合も、LINE側で重複送信が防がれる
+def retry_key_for(result_id, part_keys):
+    return str(uuid.uuid5(RETRY_KEY_NAMESPACE, f"{result_id}:{'|'.join(part_keys)}"))
+
+# 送信の単位のID（ダイジェストモードで処理された結果はダイジェストID、それ以外は結果ID）
+def delivery_unit_id(result):
+    return result.get('digest_id') or result.result_id
+
+# 未送信の結果を送信の単位ごとにまとめる（順序は保持）
+def group_delivery_units(results):
+    units = {}
+    for result in results:
+        units.setdefault(delivery_unit_id(result), []).append(result)
+    return list(units.items())
+
+# 未送信のメッセージだけをプッシュ1回あたりの上限ごとにまとめて送信
+# partsは (メッセージのキー, メッセージ) のリスト、send_messageは (user_id, messages, retry_key) を受け取る送信関数
+# プッシュが成功するたびに配信ログへ記録する
+def send_packed_messages(user_id, result_id, parts, delivery_log, send_message):
+    pending = [part for part in parts if not delivery_log.is_delivered(result_id, part[0])]
+    if len(pending) < len(parts):
+        print(f"Skipping {len(parts) - len(pending)} already delivered messages for result: {result_id}")
+
+    batches = pack_messages(pending)
+    for i, batch in enumerate(batches, 1):
+        part_keys = [part_key for part_key, _ in batch]
+        retry_key = retry_key_for(result_id, part_keys)
+        if not send_message(user_id, [message for _, message in batch], retry_key):
+            print(f"Failed to send message batch {i}/{len(batches)} to user: {user_id}")
+            return False
+        delivery_log.record(result_id, part_keys, retry_key)
+    return True
+
+class DeliveryLog:
+    def __init__(self, path=DELIVERY_LOG_PATH):
+        self.path = path
+        self.entries = []
+        self.delivered = set()
+        self._load()
+
+    # 配信ログを読み込む
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # 書き込み途中で中断した行は無視する
+                        continue
+                    self.entries.append(entry)
+                    self.delivered.add((entry['result_id'], entry['part']))
+        except Exception as e:
+            print(f"Error reading delivery log: {e}")
+
+    # 送信済みかを確認
+    def is_delivered(self, result_id, part_key):
+        return (result_id, part_key) in self.delivered
+
+    # 送信済みとして記録（すぐにファイルへ書き込む）
+    def record(self, result_id, part_keys, retry_key):
+        sent_at = datetime.now().isoformat()
+        entries = [
+            {
+                'result_id': result_id,
+                'part': part_key,
+                'retry_key': retry_key,
+                'sent_at': sent_at
+            }
+            for part_key in part_keys
+        ]
+        try:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(''.join(json.dumps(entry, ensure_ascii=False) + '\n' for entry in entries))
+                f.flush()
+                os.fsync(f.fileno())
+        except Exception as e:
+            print(f"Error writing delivery log: {e}")
+        for entry in entries:
+            self.entries.append(entry)
+            self.delivered.add((result_id, entry['part']))
+
+    # 指定した結果の記録だけを残してファイルを書き直す
+    # データベースに送信済みとして保存された結果の記録は不要になるため削除する
+    def compact(self, result_ids):
+        result_ids = set(result_ids)
+        entries = [entry for entry in self.entries if entry['result_id'] in result_ids]
+        if len(entries) == len(self.entries):
+            return
+        try:
+            temp_path = f"{self.path}.tmp"
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                for entry in entries:
+                    f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+            os.replace(temp_path, self.path)
+        except Exception as e:
+            print(f"Error compacting delivery log: {e}")
+            return
+        self.entries = entries
+        self.delivered = {(entry['result_id'], entry['part']) for entry in entries}
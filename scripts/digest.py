@@ -0,0 +1,81 @@
+import os
+import re
+
+# ダイジェストモード
+# 同じユーザーの未処理のアイデアをまとめて1回のリクエストで処理し（アイデア同士の関連も踏まえてブラッシュアップ）、
+# 翌朝はまとめて1つのメッセージセットとして送信する
+
+# ダイジェストモードを使うか（環境変数 DIGEST_MODE=1 で有効）
+DIGEST_MODE = os.environ.get('DIGEST_MODE', '').lower() in ('1', 'true', 'yes')
+
+# 1回のリクエストにまとめるアイデアの最大件数
+DIGEST_MAX_IDEAS = int(os.environ.get('DIGEST_MAX_IDEAS') or 5)
+
+# 1回のリクエストのトークン数の上限（プロンプト＋応答、gpt-4のコンテキスト長に収まるように）
+DIGEST_TOKEN_LIMIT = int(os.environ.get('DIGEST_TOKEN_LIMIT') or 8000)
+
+# 見積もりに使う値（日本語はおおよそ1文字1トークン）
+DIGEST_PROMPT_TOKENS = 400            # 指示文のトークン数
+DIGEST_OUTPUT_TOKENS_PER_IDEA = 800   # アイデア1件あたりの応答のトークン数
+DIGEST_MINDMAP_TOKENS = 1000          # まとめたマインドマップのトークン数
+
+# 応答の見出し
+IDEA_HEADING = 'アイデア'
+MINDMAP_HEADING = 'マインドマップ'
+HEADING_PATTERN = re.compile(r'^\s*=+\s*(アイデア\s*(\d+)|マインドマップ)\s*=+\s*$', re.MULTILINE)
+
+# 応答のmax_tokens
+def digest_max_tokens(idea_count, include_mindmap):
+    return idea_count * DIGEST_OUTPUT_TOKENS_PER_IDEA + (DIGEST_MINDMAP_TOKENS if include_mindmap else 0)
+
+# リクエスト全体のトークン数の見積もり
+def estimate_digest_tokens(ideas, include_mindmap):
+    prompt_tokens = DIGEST_PROMPT_TOKENS + sum(len(idea.content) for idea in ideas)
+    return prompt_tokens + digest_max_tokens(len(ideas), include_mindmap)
+
+# 先頭から順に、1回のリクエストに収まるだけのアイデアを選ぶ
+def take_digest_chunk(ideas, include_mindmap):
+    chunk = []
+    for idea in ideas:
+        if len(chunk) >= DIGEST_MAX_IDEAS:
+            break
+        if chunk and estimate_digest_tokens(chunk + [idea], include_mindmap) > DIGEST_TOKEN_LIMIT:
+            break
+        chunk.append(idea)
+    return chunk
+
+# まとめて処理するためのプロンプト
+def build_digest_messages(ideas, include_mindmap):
+    instructions = [
+        f"以下の{len(ideas)}件のアイデアを、それぞれブラッシュアップしてください。",
+        f"各アイデアの結果は「=== {IDEA_HEADING}N ===」（Nはアイデアの番号）という見出しの行の後に書いてください。",
+    ]
+    if include_mindmap:
+        instructions.append(
+            f"最後に「=== {MINDMAP_HEADING} ===」という見出しの行の後に、すべてのアイデアをまとめたテキスト形式のマインドマップを作成してください。"
+            "階層はインデントで表現し、各項目の前には記号（例：*、-、+など）を付けてください。"
+        )
+    ideas_text = "\n\n".join(
+        f"【{IDEA_HEADING}{i}】\n{idea.content}" for i, idea in enumerate(ideas, 1)
+    )
+    return [
+        {"role": "system", "content": "あなたは創造的なアイデアを発展させるアシスタントです。同じユーザーが一晩に送った複数のアイデアを、互いの関連も踏まえて分析し、それぞれを発展させ、より具体的で実用的なものにしてください。"},
+        {"role": "user", "content": "\n".join(instructions) + f"\n\n{ideas_text}"}
+    ]
+
+# 応答をアイデアごとのブラッシュアップとマインドマップに分ける
+# 見出しが揃っていない場合はNoneを返す（アイデアごとの処理に切り替える）
+def parse_digest_response(text, idea_count, include_mindmap):
+    sections = {}
+    matches = list(HEADING_PATTERN.finditer(text))
+    for i, match in enumerate(matches):
+        end = matches[i + 1].start() if i + 1 < len(matches) else len(text)
+        body = text[match.end():end].strip()
+        key = int(match.group(2)) if match.group(2) else MINDMAP_HEADING
+        sections[key] = body
+
+    enhancements = [sections.get(i, '') for i in range(1, idea_count + 1)]
+    mindmap = sections.get(MINDMAP_HEADING, '')
+    if not all(enhancements) or (include_mindmap and not mindmap):
+        return None
+    return enhancements, mindmap
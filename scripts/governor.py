@@ -0,0 +1,325 @@
+import os
+import json
+import time
+from dataclasses import dataclass, field
+from datetime import datetime
+
+# 夜間処理のコスト・処理時間ガバナー
+# 過去の実行記録からアイデア1件あたりのトークン数・処理時間を見積もり、
+# トークン予算と締め切り時刻に収まるように処理内容を計画する
+# 収まらない場合は、優先度の低いアイデアから順に
+# 安価なモデルへの切り替え → マインドマップの省略 → 翌日以降への延期 の順に段階的に落とす
+
+# 実行記録のファイルパス
+RUN_METRICS_PATH = os.environ.get('RUN_METRICS_PATH', 'data/run_metrics.json')
+
+# 保持する実行記録の件数
+MAX_RUN_HISTORY = 30
+
+# 使用するモデル
+PRIMARY_MODEL = os.environ.get('OPENAI_MODEL') or 'gpt-4'
+CHEAP_MODEL = os.environ.get('OPENAI_CHEAP_MODEL') or 'gpt-3.5-turbo'
+
+# 処理内容の段階（数字が大きいほど安価）
+LEVEL_FULL = 0          # 通常のモデルでブラッシュアップ・マインドマップを生成
+LEVEL_CHEAP_MODEL = 1   # 安価なモデルに切り替え
+LEVEL_SKIP_MINDMAP = 2  # 安価なモデルでブラッシュアップのみ（マインドマップを省略）
+LEVEL_DEFERRED = 3      # 今夜は処理せず翌日以降に延期
+
+LEVEL_NAMES = {
+    LEVEL_FULL: 'full',
+    LEVEL_CHEAP_MODEL: 'cheap_model',
+    LEVEL_SKIP_MINDMAP: 'skip_mindmap',
+    LEVEL_DEFERRED: 'deferred',
+}
+
+# 実行記録がない場合の1回あたりの見積もり（トークン数・秒）
+DEFAULT_CALL_ESTIMATES = {
+    'enhance': {'tokens': 1300, 'seconds': 30.0},
+    'mindmap': {'tokens': 1800, 'seconds': 40.0},
+}
+
+# ダイジェストモードの呼び出しの種類（マインドマップを含むか）
+# 実績はまとめたアイデアの件数を回数として記録するため、1回あたりの見積もりはアイデア1件あたりになる
+DIGEST_KIND = 'digest'
+DIGEST_SKIP_MINDMAP_KIND = 'digest_skip_mindmap'
+
+def digest_kind(include_mindmap):
+    return DIGEST_KIND if include_mindmap else DIGEST_SKIP_MINDMAP_KIND
+
+# 失敗した呼び出しの種類（例外・ダイジェストの応答を分けられなかった場合）
+# トークン数は使った予算に含めるが、見積もりに使う平均には含めない
+def failed_kind(kind):
+    return f"{kind}_failed"
+
+# 安価なモデルの処理時間の比率（実行記録がない場合）
+CHEAP_MODEL_LATENCY_RATIO = 0.3
+
+# カスケードで通常のモデルに作り直す割合（実行記録がない場合）
+DEFAULT_ESCALATION_RATE = 0.5
+
+# 複雑なアイデアとして最初から通常のモデルで生成する割合（実行記録がない場合）
+DEFAULT_COMPLEX_SHARE = 0.3
+
+# 環境変数から数値を取得（未設定・空文字の場合は既定値）
+def _env_number(name, default):
+    value = os.environ.get(name)
+    if not value:
+        return default
+    try:
+        return float(value)
+    except ValueError:
+        print(f"Invalid value for {name}: {value}")
+        return default
+
+# トークン予算と処理時間の上限
+NIGHT_TOKEN_BUDGET = _env_number('NIGHT_TOKEN_BUDGET', 300000)
+NIGHT_DEADLINE_SECONDS = _env_number('NIGHT_DEADLINE_SECONDS', 50 * 60)
+
+# 実行記録を読み込む
+def load_run_metrics(path=RUN_METRICS_PATH):
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f).get('runs', [])
+    except FileNotFoundError:
+        return []
+    except Exception as e:
+        print(f"Error reading run metrics: {e}")
+        return []
+
+# 実行記録を保存（最新のMAX_RUN_HISTORY件のみ保持）
+def save_run_metrics(runs, path=RUN_METRICS_PATH):
+    try:
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({'runs': runs[-MAX_RUN_HISTORY:]}, f, ensure_ascii=False, indent=2)
+        return True
+    except Exception as e:
+        print(f"Error saving run metrics: {e}")
+        return False
+
+@dataclass(slots=True)
+class Decision:
+    level: int = LEVEL_FULL
+    model: str = PRIMARY_MODEL
+    skip_mindmap: bool = False
+    reason: str = ''
+    estimated_tokens: int = 0
+    estimated_seconds: float = 0.0
+
+    @property
+    def deferred(self):
+        return self.level == LEVEL_DEFERRED
+
+    # 結果のメタデータとして保存する形式
+    def to_metadata(self):
+        return {
+            'level': LEVEL_NAMES[self.level],
+            'model': self.model,
+            'skip_mindmap': self.skip_mindmap,
+            'reason': self.reason,
+            'estimated_tokens': self.estimated_tokens,
+            'estimated_seconds': round(self.estimated_seconds, 1)
+        }
+
+@dataclass
+class NightGovernor:
+    token_budget: float = NIGHT_TOKEN_BUDGET
+    deadline_seconds: float = NIGHT_DEADLINE_SECONDS
+    history: list = field(default_factory=list)
+    primary_model: str = PRIMARY_MODEL
+    cheap_model: str = CHEAP_MODEL
+    cascade: bool = False
+    digest: bool = False
+    started_at: float = field(default_factory=time.monotonic)
+    spent_tokens: int = 0
+    calls: dict = field(default_factory=dict)
+    decisions: dict = field(default_factory=dict)
+    replan_needed: bool = False
+
+    # 過去の実行記録と今回の実績から1回あたりのトークン数・処理時間の平均を求める（実績がない場合はNone）
+    def average_call(self, kind, model):
+        count = tokens = seconds = 0
+        for run in self.history + [{'calls': self.calls}]:
+            stats = run.get('calls', {}).get(f"{kind}:{model}")
+            if stats:
+                count += stats.get('count', 0)
+                tokens += stats.get('tokens', 0)
+                seconds += stats.get('seconds', 0.0)
+        if count:
+            return tokens / count, seconds / count
+        return None
+
+    # 過去の実行記録から1回あたりのトークン数・処理時間を見積もる
+    def estimate_call(self, kind, model):
+        average = self.average_call(kind, model)
+        if average:
+            return average
+
+        default = DEFAULT_CALL_ESTIMATES[kind]
+        if model == self.primary_model:
+            return default['tokens'], default['seconds']
+        return default['tokens'], default['seconds'] * CHEAP_MODEL_LATENCY_RATIO
+
+    # 過去の実行記録からカスケードで通常のモデルに作り直す割合を見積もる
+    def escalation_rate(self, kind):
+        accepted = escalated = 0
+        for run in self.history:
+            stats = run.get('cascade', {}).get(kind)
+            if stats:
+                accepted += stats.get('accepted', 0)
+                escalated += stats.get('escalated', 0)
+        if accepted + escalated:
+            return escalated / (accepted + escalated)
+        return DEFAULT_ESCALATION_RATE
+
+    # 過去の実行記録から複雑なアイデア（最初から通常のモデルで生成する）の割合を見積もる
+    def complex_share(self, kind):
+        complex_count = total = 0
+        for run in self.history:
+            stats = run.get('cascade', {}).get(kind)
+            if stats:
+                complex_count += stats.get('complex', 0)
+                total += stats.get('accepted', 0) + stats.get('escalated', 0) + stats.get('complex', 0)
+        if total:
+            return complex_count / total
+        return DEFAULT_COMPLEX_SHARE
+
+    # 処理内容の段階ごとの1回あたりの見積もり
+    # カスケードを使う場合、通常の段階は
+    # 「複雑なアイデアの割合×通常のモデル＋それ以外の割合×（安価なモデル＋作り直す割合×通常のモデル）」で見積もる
+    def estimate_kind(self, kind, level):
+        if level != LEVEL_FULL:
+            return self.estimate_call(kind, self.cheap_model)
+        tokens, seconds = self.estimate_call(kind, self.primary_model)
+        if not self.cascade or self.cheap_model == self.primary_model:
+            return tokens, seconds
+        rate = self.escalation_rate(kind)
+        share = self.complex_share(kind)
+        cheap_tokens, cheap_seconds = self.estimate_call(kind, self.cheap_model)
+        return (
+            share * tokens + (1 - share) * (cheap_tokens + rate * tokens),
+            share * seconds + (1 - share) * (cheap_seconds + rate * seconds)
+        )
+
+    # 処理内容の段階ごとのアイデア1件あたりの見積もり
+    # ダイジェストモードでは、ダイジェストの実績があればアイデア1件あたりの実績で見積もる
+    def estimate_level(self, level):
+        if level == LEVEL_DEFERRED:
+            return 0, 0.0
+        if self.digest:
+            model = self.primary_model if level == LEVEL_FULL else self.cheap_model
+            average = self.average_call(digest_kind(level != LEVEL_SKIP_MINDMAP), model)
+            if average:
+                return average
+        tokens, seconds = self.estimate_kind('enhance', level)
+        if level != LEVEL_SKIP_MINDMAP:
+            mindmap_tokens, mindmap_seconds = self.estimate_kind('mindmap', level)
+            tokens += mindmap_tokens
+            seconds += mindmap_seconds
+        return tokens, seconds
+
+    # 残りの予算・時間
+    def remaining(self):
+        elapsed = time.monotonic() - self.started_at
+        return self.token_budget - self.spent_tokens, self.deadline_seconds - elapsed
+
+    # 残りのアイデアの処理内容を計画する
+    # ideasは優先度の高い順に並んでいること
+    def plan(self, ideas):
+        self.replan_needed = False
+        remaining_tokens, remaining_seconds = self.remaining()
+        estimates = {level: self.estimate_level(level) for level in LEVEL_NAMES}
+        levels = [LEVEL_FULL] * len(ideas)
+        total_tokens = estimates[LEVEL_FULL][0] * len(ideas)
+        total_seconds = estimates[LEVEL_FULL][1] * len(ideas)
+
+        # 制限を超える原因（トークン予算・締め切り）
+        exceeded = []
+        if total_tokens > remaining_tokens:
+            exceeded.append(f"token budget ({int(total_tokens)} > {int(max(remaining_tokens, 0))} tokens)")
+        if total_seconds > remaining_seconds:
+            exceeded.append(f"deadline ({int(total_seconds)}s > {int(max(remaining_seconds, 0))}s)")
+
+        # 収まるまで、優先度の低いアイデアから1段階ずつ落とす
+        for level in (LEVEL_CHEAP_MODEL, LEVEL_SKIP_MINDMAP, LEVEL_DEFERRED):
+            for i in reversed(range(len(ideas))):
+                if total_tokens <= remaining_tokens and total_seconds <= remaining_seconds:
+                    break
+                previous = estimates[levels[i]]
+                total_tokens += estimates[level][0] - previous[0]
+                total_seconds += estimates[level][1] - previous[1]
+                levels[i] = level
+
+        # 同じ段階のアイデアは同じ判断内容になるため、段階ごとに1つを共有する
+        decisions = {}
+        for level in LEVEL_NAMES:
+            tokens, seconds = estimates[level]
+            decisions[level] = Decision(
+                level=level,
+                model=self.primary_model if level == LEVEL_FULL else self.cheap_model,
+                skip_mindmap=level >= LEVEL_SKIP_MINDMAP,
+                reason=self._reason(level, len(ideas), exceeded),
+                estimated_tokens=int(tokens),
+                estimated_seconds=seconds
+            )
+        for idea, level in zip(ideas, levels):
+            self.decisions[idea.idea_id] = decisions[level]
+        return [self.decisions[idea.idea_id] for idea in ideas]
+
+    def _reason(self, level, idea_count, exceeded):
+        if level == LEVEL_FULL:
+            return 'within limits'
+        return f"projected {idea_count} remaining ideas exceed {' and '.join(exceeded)}"
+
+    # queue[index]のアイデアの処理内容を取得
+    # 前回の計画以降にAPIを呼び出した（アイデアを処理した）場合だけ、実績を反映して残りを再計画する
+    # 延期は優先度の低いアイデアから決まるため、延期になったアイデア以降は再計画せずにすべて延期する
+    # doneには先に処理したアイデア（ダイジェストモードでまとめて処理した後続のアイデア）のIDを渡す
+    def decide(self, queue, index, done=()):
+        idea = queue[index]
+        decision = self.decisions.get(idea.idea_id)
+        if decision is None or (self.replan_needed and not decision.deferred):
+            self.plan([other for other in queue[index:] if other.idea_id not in done])
+            decision = self.decisions[idea.idea_id]
+        return decision
+
+    # OpenAI APIの呼び出し実績を記録
+    # countはこの呼び出しで処理したアイデアの件数（ダイジェストモードで複数のアイデアをまとめた場合）
+    def record_call(self, kind, model, tokens, seconds, count=1):
+        stats = self.calls.setdefault(f"{kind}:{model}", {'count': 0, 'tokens': 0, 'seconds': 0.0})
+        stats['count'] += count
+        stats['tokens'] += tokens
+        stats['seconds'] = round(stats['seconds'] + seconds, 3)
+        self.spent_tokens += tokens
+        self.replan_needed = True
+
+    # 今回の実行記録
+    def run_metrics(self):
+        counts = {}
+        for decision in self.decisions.values():
+            name = LEVEL_NAMES[decision.level]
+            counts[name] = counts.get(name, 0) + 1
+        return {
+            'finished_at': datetime.now().isoformat(),
+            'token_budget': self.token_budget,
+            'deadline_seconds': self.deadline_seconds,
+            'spent_tokens': self.spent_tokens,
+            'elapsed_seconds': round(time.monotonic() - self.started_at, 1),
+            'decisions': counts,
+            'calls': self.calls
+        }
+
+# アイデアを優先度の高い順に並べる
+# 各ユーザーの1件目を優先し（ユーザー間の公平性）、同じ順位の中では古いものを優先する
+def prioritize(ideas):
+    ranks = {}
+    ranked = []
+    for idea in sorted(ideas, key=lambda idea: idea.created_at):
+        rank = ranks.get(idea.user_id, 0)
+        ranks[idea.user_id] = rank + 1
+        ranked.append((rank, idea.created_at, idea))
+    ranked.sort(key=lambda item: (item[0], item[1]))
+    return [idea for _, _, idea in ranked]
@@ -0,0 +1,100 @@
+# LINEメッセージの分割・まとめ送信
+# 長文は段落・文の区切りで必要なだけ分割し、プッシュ1回あたり5件までのメッセージに詰めて送信回数を減らす
+
+# テキストメッセージの最大文字数（LINEの制限、UTF-16の単位で数える）
+MAX_TEXT_LENGTH = 5000
+
+# プッシュ1回で送信できるメッセージ数（LINEの制限）
+MAX_MESSAGES_PER_REQUEST = 5
+
+# 分割位置の候補（優先度の高い順）
+# 段落 → 行 → 文末（日本語の句点・感嘆符を含む） → 読点
+SPLIT_SEPARATORS = [
+    ['\n\n'],
+    ['\n'],
+    ['。', '！', '？', '!', '?', '．'],
+    ['、', '，', ',', ' ', '　'],
+]
+
+# 文末の直後に続く閉じ括弧（括弧の途中で分割しないよう区切りに含める）
+CLOSING_BRACKETS = '」』）)】〉》"\''
+
+# 分割位置がこれより前にしか見つからない場合は、次の候補を試す
+MIN_FILL_RATIO = 0.5
+
+# LINEの文字数制限と同じ単位（UTF-16）で長さを数える
+def text_length(text):
+    return len(text.encode('utf-16-le')) // 2
+
+# 制限内に収まる先頭部分の文字数
+def _fit(text, max_length):
+    end = min(len(text), max_length)
+    while end > 0 and text_length(text[:end]) > max_length:
+        end -= max(1, (text_length(text[:end]) - max_length) // 2)
+    return end
+
+# 先頭部分で最も良い分割位置を探す
+def _find_split(text, end):
+    window = text[:end]
+    for separators in SPLIT_SEPARATORS:
+        best = -1
+        for separator in separators:
+            position = window.rfind(separator)
+            if position < 0:
+                continue
+            position += len(separator)
+            # 閉じ括弧は前の文に含める
+            while position < end and window[position] in CLOSING_BRACKETS:
+                position += 1
+            best = max(best, position)
+        if best >= end * MIN_FILL_RATIO:
+            return best
+    return end
+
+# テキストを制限内の長さに分割
+# first_max_lengthを指定すると、最初の部分だけ別の長さ（見出しなどを付ける場合）で分割する
+def split_text(text, max_length, first_max_length=None):
+    if max_length <= 0:
+        raise ValueError("max_length must be positive")
+
+    parts = []
+    remaining = text
+    limit = first_max_length if first_max_length is not None else max_length
+    while text_length(remaining) > limit:
+        end = _fit(remaining, max(1, limit))
+        position = _find_split(remaining, end)
+        part = remaining[:position].rstrip('\n')
+        if part:
+            parts.append(part)
+        remaining = remaining[position:].lstrip('\n')
+        limit = max_length
+    if remaining or not parts:
+        parts.append(remaining)
+    return parts
+
+# 見出し付きのテキストメッセージを作成（長文の場合は「(1/3)」のように分割）
+def build_text_messages(label, body, prefix='', max_length=MAX_TEXT_LENGTH):
+    header = f"{prefix}【{label}】\n"
+    if text_length(header) + text_length(body) <= max_length:
+        return [{'type': 'text', 'text': f"{header}{body}"}]
+
+    # 分割数の桁が増えても収まるように、見出しの長さには余裕を持たせる
+    reserved = text_length(f"【{label} (999/999)】\n")
+    parts = split_text(body, max_length - reserved, max_length - reserved - text_length(prefix))
+    total = len(parts)
+
+    messages = []
+    for i, part in enumerate(parts, 1):
+        part_prefix = prefix if i == 1 else ''
+        messages.append({
+            'type': 'text',
+            'text': f"{part_prefix}【{label} ({i}/{total})】\n{part}"
+        })
+    return messages
+
+# メッセージをプッシュ1回あたりの上限ごとにまとめる（順序は保持）
+def pack_messages(messages, max_per_request=MAX_MESSAGES_PER_REQUEST):
+    return [
+        messages[i:i + max_per_request]
+        for i in range(0, len(messages), max_per_request)
+    ]
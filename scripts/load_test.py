@@ -0,0 +1,470 @@
+import os
+import sys
+import json
+import time
+import base64
+import random
+import hashlib
+import argparse
+import tempfile
+import tracemalloc
+import subprocess
+import contextlib
+from digest import IDEA_HEADING, MINDMAP_HEADING
+
+# 負荷試験・リプレイツール
+# 記録されたデータベースのスナップショットからアイデアを取り出し、文面を少しずつ変えながら件数を増やして、
+# 受信（Webhookによるアイデアの保存）→ 夜間処理 → 朝の通知 をローカルのスタブに対して通しで実行する
+# 段階ごとのスループット・レイテンシのパーセンタイル・メモリ使用量を計測し、保存されたベースラインと比較する
+
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# ベースラインのファイルパス
+BASELINE_PATH = os.path.join(SCRIPTS_DIR, '..', 'data', 'load_test_baseline.json')
+
+# 外部サービスのスタブの応答時間（秒、実行時は --time-scale 倍する）
+STUB_LATENCIES = {
+    'openai': 20.0,         # 通常のモデル
+    'openai_cheap': 5.0,    # 安価なモデル
+    'github': 1.0,          # データベースの取得・更新
+    'line_push': 0.3,       # LINEのプッシュ
+    'mindmap_render': 2.0,  # マインドマップ画像の生成・送信
+}
+
+# スタブの応答時間のばらつき（±の割合）
+STUB_JITTER = 0.3
+
+# 文面を変えるための語句
+VARIATION_PREFIXES = ['', 'もっと手軽に', '地域向けに', '学生でも使える', '高齢者にもやさしい', '週末だけの']
+VARIATION_SUFFIXES = ['', '。できれば無料で', '。LINEだけで完結させたい', '。まずは小さく試したい', '。AIも活用したい']
+
+# レイテンシの差がこれ未満の場合は、比率が許容範囲を超えても回帰とみなさない（計測誤差）
+MIN_LATENCY_DELTA_MS = 1.0
+
+# 計測回数がこれ未満のレイテンシは比較しない（パーセンタイルが1回の計測で大きく変わるため）
+MIN_LATENCY_SAMPLES = 20
+
+# メモリ使用量の差がこれ未満の場合は回帰とみなさない
+MIN_MEMORY_DELTA_MIB = 1.0
+
+# 受信のスループットが到着レートのこの割合を下回る場合は、受信が処理能力を超えている（飽和）とみなす
+SATURATION_RATIO = 0.9
+
+# スナップショットを読み込む（ファイルパス、または「リビジョン:パス」でgitの履歴から）
+def load_snapshot(source):
+    if os.path.exists(source):
+        with open(source, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    output = subprocess.run(
+        ['git', 'show', source], cwd=SCRIPTS_DIR, capture_output=True, text=True, check=True
+    ).stdout
+    return json.loads(output)
+
+# スナップショットからアイデアと、スタブの応答に使うブラッシュアップ・マインドマップを集める
+def collect_recorded(snapshots):
+    ideas = {}
+    enhancements = []
+    mindmaps = []
+    for database in snapshots:
+        ideas.update(database.get('ideas', {}))
+        for result in database.get('results', {}).values():
+            if result.get('enhanced_content'):
+                enhancements.append(result['enhanced_content'])
+            if result.get('mindmap_content'):
+                mindmaps.append(result['mindmap_content'])
+    return ideas, enhancements, mindmaps
+
+# 文面を少し変える（1件目はそのまま）
+def vary_text(text, copy, rng):
+    if copy == 0:
+        return text
+    sentences = [sentence for sentence in text.split('。') if sentence]
+    if len(sentences) > 1 and rng.random() < 0.5:
+        rng.shuffle(sentences)
+    varied = '。'.join(sentences)
+    return f"{rng.choice(VARIATION_PREFIXES)}{varied}{rng.choice(VARIATION_SUFFIXES)} ({copy})"
+
+# 記録されたアイデアを指定した倍率に増やす（ユーザーも同じ倍率で増やす）
+def scale_ideas(recorded_ideas, scale, seed=0):
+    rng = random.Random(seed)
+    ideas = []
+    serial = 0
+    for copy in range(scale):
+        for idea_id, data in sorted(recorded_ideas.items(), key=lambda item: item[1].get('created_at', '')):
+            serial += 1
+            user_id = data.get('user_id', '')
+            if copy:
+                user_id = f"U{hashlib.md5(f'{user_id}:{copy}'.encode('utf-8')).hexdigest()}"
+            ideas.append((f"{idea_id[:14]}{serial:06d}", {
+                'user_id': user_id,
+                'content': vary_text(data.get('content', ''), copy, rng),
+                'created_at': data.get('created_at', ''),
+                'processed': False
+            }))
+    return ideas
+
+def percentile(values, ratio):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * ratio))]
+
+# 処理ごとの所要時間を記録する
+class Recorder:
+    def __init__(self):
+        self.latencies = {}
+        self.patches = []
+
+    def add(self, name, seconds):
+        self.latencies.setdefault(name, []).append(seconds)
+
+    # モジュールの関数を所要時間を記録する関数に置き換える
+    # nameは呼び出しの引数から記録名を決める関数でもよい
+    def wrap(self, module, attribute, name):
+        original = getattr(module, attribute)
+
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return original(*args, **kwargs)
+            finally:
+                self.add(name(*args) if callable(name) else name, time.perf_counter() - start)
+
+        self.patch(module, attribute, wrapper)
+
+    def patch(self, module, attribute, value):
+        self.patches.append((module, attribute, getattr(module, attribute)))
+        setattr(module, attribute, value)
+
+    def restore(self):
+        for module, attribute, original in reversed(self.patches):
+            setattr(module, attribute, original)
+        self.patches = []
+
+    # 記録名ごとの件数とパーセンタイル（ミリ秒）
+    def summary(self):
+        return {
+            name: {
+                'count': len(values),
+                'p50_ms': round(percentile(values, 0.5) * 1000, 3),
+                'p95_ms': round(percentile(values, 0.95) * 1000, 3),
+                'p99_ms': round(percentile(values, 0.99) * 1000, 3),
+            }
+            for name, values in sorted(self.latencies.items())
+        }
+
+# 外部サービスのスタブ（応答時間は --time-scale 倍、乱数は固定のシードで再現可能）
+class Stubs:
+    def __init__(self, time_scale, enhancements, mindmaps, seed=0):
+        self.time_scale = time_scale
+        self.rng = random.Random(seed)
+        self.enhancements = enhancements or ['ブラッシュアップしたアイデアです。']
+        self.mindmaps = mindmaps or ['* アイデア\n  - 要素']
+        self.pushes = 0
+        self.renders = 0
+
+    def wait(self, kind):
+        latency = STUB_LATENCIES[kind] * (1 + self.rng.uniform(-STUB_JITTER, STUB_JITTER))
+        time.sleep(latency * self.time_scale)
+
+    # time.sleepだけを倍率に合わせて短くしたtimeモジュールの代わり
+    def scaled_time(self):
+        stubs = self
+
+        class ScaledTime:
+            def __getattr__(self, name):
+                return getattr(time, name)
+
+            def sleep(self, seconds):
+                time.sleep(seconds * stubs.time_scale)
+
+        return ScaledTime()
+
+    # openaiモジュールの代わり（ChatCompletion.createのみ）
+    def openai(self, primary_model):
+        stubs = self
+
+        class ChatCompletion:
+            @staticmethod
+            def create(model, messages, max_tokens=None, **kwargs):
+                stubs.wait('openai' if model == primary_model else 'openai_cheap')
+                prompt = messages[-1]['content']
+                idea_count = prompt.count(f"【{IDEA_HEADING}")
+                if idea_count:
+                    # ダイジェストモードの応答
+                    sections = [
+                        f"=== {IDEA_HEADING}{i} ===\n{stubs.rng.choice(stubs.enhancements)}"
+                        for i in range(1, idea_count + 1)
+                    ]
+                    sections.append(f"=== {MINDMAP_HEADING} ===\n{stubs.rng.choice(stubs.mindmaps)}")
+                    content = '\n\n'.join(sections)
+                elif 'マインドマップ' in messages[0]['content']:
+                    content = stubs.rng.choice(stubs.mindmaps)
+                else:
+                    content = stubs.rng.choice(stubs.enhancements)
+                tokens = len(prompt) + len(content)
+                return type('Response', (), {
+                    'choices': [type('Choice', (), {'message': {'content': content}})()],
+                    'usage': {'total_tokens': tokens}
+                })()
+
+        return type('OpenAI', (), {'ChatCompletion': ChatCompletion})()
+
+    # GitHub APIの代わりにローカルのファイルを読み書きする
+    def database_functions(self, path):
+        # 環境変数で決まる定数を確定させないよう、夜間処理のスクリプトを読み込んでから読み込む
+        from records import RecordStore
+
+        def get_database():
+            self.wait('github')
+            with open(path, 'r', encoding='utf-8') as f:
+                return RecordStore.from_json(f.read()), 'replay'
+
+        def update_database(database, sha):
+            self.wait('github')
+            content = json.dumps(database, ensure_ascii=False, indent=2)
+            # GitHub APIに送るためのBase64エンコードの処理時間を再現する（結果は使わない）
+            base64.b64encode(content.encode('utf-8'))
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write(content)
+            return True
+
+        return get_database, update_database
+
+    def send_line_message(self, user_id, messages, retry_key=None):
+        self.wait('line_push')
+        self.pushes += 1
+        return True
+
+    def generate_and_send_mindmap(self, user_id, mindmap_content, result_id, retry_key=None):
+        self.wait('mindmap_render')
+        self.renders += 1
+        key = hashlib.sha256(mindmap_content.encode('utf-8')).hexdigest()
+        return True, f"mindmap_{key}.svg"
+
+# 段階の実行時間とメモリのピークを計測
+@contextlib.contextmanager
+def measure_stage(stages, name, items):
+    tracemalloc.reset_peak()
+    start = time.perf_counter()
+    stage = {'items': items}
+    stages[name] = stage
+    yield stage
+    elapsed = time.perf_counter() - start
+    stage['seconds'] = round(elapsed, 3)
+    stage['throughput_per_s'] = round(stage['items'] / elapsed, 2) if elapsed else 0
+    stage['peak_memory_mib'] = round(tracemalloc.get_traced_memory()[1] / 1024 / 1024, 2)
+
+# 受信：サーバー（server.js）と同じく、アイデアが届くたびにデータベースのファイルを読み込んで書き直す
+# 到着時刻は一定の間隔で予定し、予定時刻からの遅れを含めてレイテンシとする
+def run_ingest(path, ideas, arrival_rate, recorder):
+    start = time.perf_counter()
+    for i, (idea_id, data) in enumerate(ideas):
+        scheduled = start + i / arrival_rate if arrival_rate else time.perf_counter()
+        delay = scheduled - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        with open(path, 'r', encoding='utf-8') as f:
+            database = json.load(f)
+        database['users'].setdefault(data['user_id'], {'created_at': data['created_at']})
+        database['ideas'][idea_id] = data
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(database, f, ensure_ascii=False, indent=2)
+        recorder.add('ingest.idea', time.perf_counter() - scheduled)
+
+# 夜間処理・朝の通知のスクリプトを読み込む
+# 環境変数で決まる定数（ファイルパスなど）は読み込み時に確定するため、作業ディレクトリを設定してから読み込む
+def import_pipeline(work_dir):
+    os.environ['RUN_METRICS_PATH'] = os.path.join(work_dir, 'run_metrics.json')
+    os.environ['DELIVERY_LOG_PATH'] = os.path.join(work_dir, 'delivery_log.jsonl')
+    os.environ['SEARCH_INDEX_PATH'] = os.path.join(work_dir, 'search_index.sqlite3')
+    os.environ['LOCAL_DATABASE_PATH'] = os.path.join(work_dir, 'database.json')
+    # 負荷試験ではすべてのアイデアを処理する（ガバナーによる延期を起こさない）
+    os.environ.setdefault('NIGHT_TOKEN_BUDGET', '1e12')
+    os.environ.setdefault('NIGHT_DEADLINE_SECONDS', '1e9')
+    import process_ideas
+    import send_notifications
+    return process_ideas, send_notifications
+
+# 負荷試験を実行して計測結果を返す
+def run_load_test(snapshots, scale, arrival_rate, time_scale, digest_mode, seed=0):
+    recorded_ideas, enhancements, mindmaps = collect_recorded(snapshots)
+    ideas = scale_ideas(recorded_ideas, scale, seed)
+
+    # データベース・配信ログ・検索インデックスなどの作業用ファイルは終了時に削除する
+    with tempfile.TemporaryDirectory(prefix='load_test_') as work_dir:
+        database_path = os.path.join(work_dir, 'database.json')
+        with open(database_path, 'w', encoding='utf-8') as f:
+            json.dump({'users': {}, 'ideas': {}, 'results': {}}, f)
+
+        process_ideas, send_notifications = import_pipeline(work_dir)
+        stubs = Stubs(time_scale, enhancements, mindmaps, seed)
+        recorder = Recorder()
+
+        get_database, update_database = stubs.database_functions(database_path)
+        for module in (process_ideas, send_notifications):
+            recorder.patch(module, 'get_database', get_database)
+            recorder.patch(module, 'update_database', update_database)
+            recorder.wrap(module, 'update_database', 'update_database')
+        recorder.patch(process_ideas, 'DIGEST_MODE', digest_mode)
+        recorder.patch(process_ideas, '_openai', stubs.openai(process_ideas.PRIMARY_MODEL))
+        recorder.patch(send_notifications, 'send_line_message', stubs.send_line_message)
+        recorder.patch(send_notifications, 'generate_and_send_mindmap', stubs.generate_and_send_mindmap)
+        recorder.patch(send_notifications, 'time', stubs.scaled_time())
+
+        recorder.wrap(process_ideas, 'create_chat_completion', lambda kind, *args: f"night.openai.{kind}")
+        recorder.wrap(process_ideas, 'process_idea', 'night.idea')
+        recorder.wrap(process_ideas, 'process_digest', 'night.digest')
+        recorder.wrap(process_ideas, 'update_search_index', 'night.search_index')
+        recorder.wrap(send_notifications, 'deliver_results', 'morning.delivery')
+        recorder.wrap(send_notifications, 'send_line_message', 'morning.line_push')
+        recorder.wrap(send_notifications, 'generate_and_send_mindmap', 'morning.mindmap')
+
+        stages = {}
+        tracemalloc.start()
+        try:
+            with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                with measure_stage(stages, 'ingest', len(ideas)):
+                    run_ingest(database_path, ideas, arrival_rate, recorder)
+
+                with measure_stage(stages, 'night', len(ideas)):
+                    process_ideas.main()
+
+                with open(database_path, 'r', encoding='utf-8') as f:
+                    results = len(json.load(f)['results'])
+
+                with measure_stage(stages, 'morning', results):
+                    send_notifications.main()
+        finally:
+            tracemalloc.stop()
+            recorder.restore()
+
+        with open(database_path, 'r', encoding='utf-8') as f:
+            database = json.load(f)
+
+    return {
+        'scenario': scenario_name(scale, digest_mode),
+        'ideas': len(ideas),
+        'arrival_rate': arrival_rate,
+        'time_scale': time_scale,
+        'processed': sum(1 for idea in database['ideas'].values() if idea.get('processed')),
+        'sent': sum(1 for result in database['results'].values() if result.get('sent')),
+        'line_pushes': stubs.pushes,
+        'mindmap_renders': stubs.renders,
+        'stages': stages,
+        'latencies': recorder.summary(),
+    }
+
+def scenario_name(scale, digest_mode):
+    return f"x{scale}{'-digest' if digest_mode else ''}"
+
+# 受信が飽和しているか（到着レートが処理能力を超えると、受信のレイテンシは処理待ちの行列の長さになる）
+def ingest_saturated(report):
+    stage = report.get('stages', {}).get('ingest')
+    rate = report.get('arrival_rate')
+    return bool(rate and stage) and stage['throughput_per_s'] < rate * SATURATION_RATIO
+
+# ベースラインと比較して回帰の一覧を返す
+# 受信が飽和している場合、受信のレイテンシは処理時間を表さないため比較しない
+def find_regressions(report, baseline, tolerance):
+    regressions = []
+    skipped = {'ingest.idea'} if ingest_saturated(report) or ingest_saturated(baseline) else set()
+    for name, stage in baseline.get('stages', {}).items():
+        current = report['stages'].get(name)
+        if not current:
+            continue
+        if current['throughput_per_s'] < stage['throughput_per_s'] * (1 - tolerance):
+            regressions.append(f"{name} throughput {current['throughput_per_s']}/s < baseline {stage['throughput_per_s']}/s")
+        if (current['peak_memory_mib'] > stage['peak_memory_mib'] * (1 + tolerance)
+                and current['peak_memory_mib'] - stage['peak_memory_mib'] >= MIN_MEMORY_DELTA_MIB):
+            regressions.append(f"{name} peak memory {current['peak_memory_mib']} MiB > baseline {stage['peak_memory_mib']} MiB")
+    for name, latency in baseline.get('latencies', {}).items():
+        current = report['latencies'].get(name)
+        if name in skipped or not current or min(current['count'], latency['count']) < MIN_LATENCY_SAMPLES:
+            continue
+        if (current['p95_ms'] > latency['p95_ms'] * (1 + tolerance)
+                and current['p95_ms'] - latency['p95_ms'] >= MIN_LATENCY_DELTA_MS):
+            regressions.append(f"{name} p95 {current['p95_ms']} ms > baseline {latency['p95_ms']} ms")
+    return regressions
+
+def print_report(report):
+    print(f"Scenario {report['scenario']}: {report['ideas']} ideas, "
+          f"{report['processed']} processed, {report['sent']} sent, "
+          f"{report['line_pushes']} LINE pushes, {report['mindmap_renders']} mindmap renders")
+    for name, stage in report['stages'].items():
+        print(f"  {name:8s} {stage['items']:6d} items in {stage['seconds']:8.2f}s "
+              f"({stage['throughput_per_s']:8.2f}/s, peak {stage['peak_memory_mib']:.1f} MiB)")
+    for name, latency in report['latencies'].items():
+        print(f"  {name:28s} n={latency['count']:6d} p50 {latency['p50_ms']:9.2f} ms "
+              f"p95 {latency['p95_ms']:9.2f} ms p99 {latency['p99_ms']:9.2f} ms")
+    if ingest_saturated(report):
+        print(f"  ingest is saturated at --arrival-rate {report['arrival_rate']}/s "
+              f"(ingest.idea latency includes queueing and is not compared)")
+
+def main():
+    parser = argparse.ArgumentParser(description='記録されたアイデアを増やして夜間処理・朝の通知を通しで実行する負荷試験')
+    parser.add_argument('--snapshot', action='append',
+                        help='データベースのスナップショット（ファイルパス、または「リビジョン:data/database.json」）。複数指定可')
+    parser.add_argument('--scale', type=int, default=10, help='アイデアを増やす倍率（10、100など）')
+    parser.add_argument('--arrival-rate', type=float, default=5, help='受信するアイデアの到着レート（件/秒、0は待たずに到着）')
+    parser.add_argument('--time-scale', type=float, default=0.001, help='スタブの応答時間・待機時間の倍率')
+    parser.add_argument('--digest', action='store_true', help='ダイジェストモードで実行')
+    parser.add_argument('--seed', type=int, default=0, help='文面の変化・スタブの応答に使う乱数のシード')
+    parser.add_argument('--baseline', default=BASELINE_PATH, help='ベースラインのファイルパス')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='ベースラインからの悪化の許容割合')
+    parser.add_argument('--update-baseline', action='store_true', help='今回の結果をベースラインとして保存')
+    parser.add_argument('--require-baseline', action='store_true',
+                        help='比較できるベースラインがない場合は失敗する（CIでの比較用）')
+    parser.add_argument('--report', help='計測結果をJSONで保存するファイルパス')
+    args = parser.parse_args()
+
+    snapshots = [load_snapshot(source) for source in args.snapshot or [os.path.join(SCRIPTS_DIR, '..', 'data', 'database.json')]]
+    report = run_load_test(snapshots, args.scale, args.arrival_rate, args.time_scale, args.digest, args.seed)
+    print_report(report)
+
+    if args.report:
+        with open(args.report, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+    if report['processed'] != report['ideas'] or report['sent'] != report['processed']:
+        print("Load test failed: pipeline did not process and send every idea")
+        sys.exit(1)
+
+    baselines = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baselines = json.load(f)
+
+    if args.update_baseline:
+        baselines[report['scenario']] = {
+            'ideas': report['ideas'],
+            'arrival_rate': report['arrival_rate'],
+            'time_scale': report['time_scale'],
+            'stages': report['stages'],
+            'latencies': report['latencies'],
+        }
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump(baselines, f, ensure_ascii=False, indent=2)
+        print(f"Baseline updated: {report['scenario']}")
+        return
+
+    baseline = baselines.get(report['scenario'])
+    if not baseline:
+        print(f"No baseline for scenario {report['scenario']} (run with --update-baseline to store one)")
+        if args.require_baseline:
+            sys.exit(1)
+        return
+    if baseline.get('arrival_rate') != report['arrival_rate'] or baseline.get('time_scale') != report['time_scale']:
+        print("Baseline was recorded with different --arrival-rate/--time-scale, skipping comparison")
+        if args.require_baseline:
+            sys.exit(1)
+        return
+
+    regressions = find_regressions(report, baseline, args.tolerance)
+    for regression in regressions:
+        print(f"Regression: {regression}")
+    if regressions:
+        print("Load test failed")
+        sys.exit(1)
+    print("Load test passed")
+
+if __name__ == "__main__":
+    main()
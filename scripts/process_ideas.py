@@ -1,9 +1,22 @@
 import os
 import json
 import base64
-import requests
-import openai
-from datetime import datetime
+import time
+import itertools
+from collections import deque
+from records import RecordStore, read_local_store
+from governor import (
+    LEVEL_NAMES, PRIMARY_MODEL, NightGovernor, digest_kind, failed_kind, load_run_metrics, prioritize, save_run_metrics
+)
+from search_index import SearchIndex
+from cascade import (
+    CASCADE_ENABLED, ROUTE_CHEAP_FIRST, ROUTE_COMPLEX, ROUTE_ESCALATED, VALIDATORS, CascadeStats, cascade_route
+)
+from digest import (
+    DIGEST_MODE, build_digest_messages, digest_max_tokens, parse_digest_response, take_digest_chunk
+)
+
+# openai・requestsは読み込みが重いため、実際に処理が必要になった時点でインポートする
 
 # 環境変数
 GITHUB_TOKEN = os.environ.get('GITHUB_TOKEN')
@@ -11,11 +24,21 @@ GITHUB_REPO_OWNER = os.environ.get('GITHUB_REPOSITORY', '').split('/')[0]
 GITHUB_REPO_NAME = os.environ.get('GITHUB_REPOSITORY', '').split('/')[-1]
 OPENAI_API_KEY = os.environ.get('OPENAI_API_KEY')
 
-# OpenAI API設定
-openai.api_key = OPENAI_API_KEY
+# OpenAIクライアントを遅延読み込み
+_openai = None
+
+def get_openai():
+    global _openai
+    if _openai is None:
+        import openai
+        openai.api_key = OPENAI_API_KEY
+        _openai = openai
+    return _openai
 
 # GitHubからデータベースを取得
 def get_database():
+    import requests
+
     headers = {
         'Authorization': f'token {GITHUB_TOKEN}',
         'Accept': 'application/vnd.github.v3+json'
@@ -30,9 +53,9 @@ def get_database():
         
         if response.status_code == 200:
             content = base64.b64decode(response.json()['content']).decode('utf-8')
-            database = json.loads(content)
+            store = RecordStore.from_json(content)
             sha = response.json()['sha']
-            return database, sha
+            return store, sha
         else:
             print(f"Error fetching database: {response.status_code}")
             print(response.text)
@@ -43,6 +66,8 @@ def get_database():
 
 # GitHubにデータベースを更新
 def update_database(database, sha):
+    import requests
+
     headers = {
         'Authorization': f'token {GITHUB_TOKEN}',
         'Accept': 'application/vnd.github.v3+json'
@@ -75,56 +100,251 @@ def update_database(database, sha):
         print(f"Exception updating database: {e}")
         return False
 
+# OpenAI APIを呼び出し、ガバナーに実績（トークン数・処理時間）を記録する
+# countはこの呼び出しで処理するアイデアの件数（ダイジェストモード）
+# parseを指定した場合は応答をparseで変換して返し、変換できなかった（Noneの）場合も失敗として記録する
+def create_chat_completion(kind, model, messages, max_tokens, governor=None, count=1, parse=None):
+    start = time.monotonic()
+    tokens = 0
+    failed = True
+    try:
+        response = get_openai().ChatCompletion.create(
+            model=model,
+            messages=messages,
+            max_tokens=max_tokens,
+            temperature=0.7
+        )
+        usage = getattr(response, 'usage', None)
+        if usage:
+            tokens = usage['total_tokens']
+        content = response.choices[0].message['content'].strip()
+        if parse is not None:
+            content = parse(content)
+        failed = content is None
+        return content
+    finally:
+        if governor is not None:
+            governor.record_call(failed_kind(kind) if failed else kind, model, tokens, time.monotonic() - start, count)
+
 # アイデアをブラッシュアップ
-def enhance_idea(idea_content):
+def enhance_idea(idea_content, model=PRIMARY_MODEL, governor=None):
     try:
-        response = openai.ChatCompletion.create(
-            model="gpt-4",
-            messages=[
+        return create_chat_completion(
+            'enhance',
+            model,
+            [
                 {"role": "system", "content": "あなたは創造的なアイデアを発展させるアシスタントです。ユーザーのアイデアを分析し、それを発展させ、より具体的で実用的なものにしてください。"},
                 {"role": "user", "content": f"以下のアイデアをブラッシュアップしてください：\n\n{idea_content}"}
             ],
             max_tokens=1000,
-            temperature=0.7
+            governor=governor
         )
-        return response.choices[0].message['content'].strip()
     except Exception as e:
         print(f"Error enhancing idea: {e}")
         return f"アイデアの処理中にエラーが発生しました。エラー: {str(e)}"
 
 # マインドマップを生成
-def generate_mindmap(idea_content):
+def generate_mindmap(idea_content, model=PRIMARY_MODEL, governor=None):
     try:
-        response = openai.ChatCompletion.create(
-            model="gpt-4",
-            messages=[
+        return create_chat_completion(
+            'mindmap',
+            model,
+            [
                 {"role": "system", "content": "あなたはアイデアからテキスト形式のマインドマップを作成するアシスタントです。中心となるアイデアから派生する概念を階層的に表現してください。"},
                 {"role": "user", "content": f"以下のアイデアからテキスト形式のマインドマップを作成してください。階層はインデントで表現し、各項目の前には記号（例：*、-、+など）を付けてください：\n\n{idea_content}"}
             ],
             max_tokens=1500,
-            temperature=0.7
+            governor=governor
         )
-        return response.choices[0].message['content'].strip()
     except Exception as e:
         print(f"Error generating mindmap: {e}")
         return f"マインドマップの生成中にエラーが発生しました。エラー: {str(e)}"
 
+# アイデアを今夜は処理せず、翌日以降に延期（未処理のまま残す）
+def defer_idea(idea, decision):
+    print(f"Deferring idea: {idea.idea_id} ({decision.reason})")
+    idea.set('deferred_nights', idea.get('deferred_nights', 0) + 1)
+
+# 処理結果を保存（ガバナーの判断と実績をメタデータとして記録）
+def save_result(store, idea, decision, enhanced_content, mindmap_content, actual_tokens, actual_seconds):
+    result = store.add_result(idea, enhanced_content, mindmap_content)
+    metadata = decision.to_metadata()
+    metadata['actual_tokens'] = actual_tokens
+    metadata['actual_seconds'] = round(actual_seconds, 1)
+    if idea.get('deferred_nights'):
+        metadata['deferred_nights'] = idea.get('deferred_nights')
+    result.set('governor', metadata)
+    
+    # アイデアを処理済みにマーク
+    idea.processed = True
+    return result
+
+# 安価なモデルから順に生成（カスケード）
+# 安価なモデルの生成がローカルの検証に通らなかった場合だけ、通常のモデルで作り直す
+# 戻り値は (生成したテキスト, 生成の経路のメタデータ)。カスケードを使わない場合のメタデータはNone
+def generate_with_cascade(kind, idea_content, decision, governor, cascade):
+    generate = enhance_idea if kind == 'enhance' else generate_mindmap
+    route = cascade_route(idea_content, decision, governor.primary_model, governor.cheap_model)
+    
+    if route is None:
+        return generate(idea_content, decision.model, governor), None
+    
+    if route == ROUTE_COMPLEX:
+        cascade.record(kind, ROUTE_COMPLEX)
+        return generate(idea_content, governor.primary_model, governor), {'route': ROUTE_COMPLEX, 'model': governor.primary_model}
+    
+    # 削減時間の計算に使う通常のモデルの見積もり
+    primary_seconds = governor.estimate_call(kind, governor.primary_model)[1]
+    start = time.monotonic()
+    text = generate(idea_content, governor.cheap_model, governor)
+    cheap_seconds = time.monotonic() - start
+    
+    reason = VALIDATORS[kind](text)
+    if reason is None:
+        cascade.record(kind, ROUTE_CHEAP_FIRST, cheap_seconds, primary_seconds)
+        return text, {'route': ROUTE_CHEAP_FIRST, 'model': governor.cheap_model}
+    
+    print(f"Escalating {kind} to {governor.primary_model}: {reason}")
+    cascade.record(kind, ROUTE_ESCALATED, cheap_seconds, primary_seconds, reason)
+    text = generate(idea_content, governor.primary_model, governor)
+    return text, {'route': ROUTE_ESCALATED, 'model': governor.primary_model, 'reason': reason}
+
+# アイデアを1件処理
+def process_idea(store, idea, decision, governor, cascade):
+    print(f"Processing idea: {idea.idea_id} (level: {LEVEL_NAMES[decision.level]}, model: {decision.model})")
+    spent_tokens = governor.spent_tokens
+    start = time.monotonic()
+    routes = {}
+    
+    # アイデアをブラッシュアップ
+    enhanced_content, routes['enhance'] = generate_with_cascade('enhance', idea.content, decision, governor, cascade)
+    
+    # マインドマップを生成（予算が足りない場合は省略）
+    mindmap_content = ''
+    if not decision.skip_mindmap:
+        mindmap_content, routes['mindmap'] = generate_with_cascade('mindmap', idea.content, decision, governor, cascade)
+    
+    result = save_result(
+        store, idea, decision, enhanced_content, mindmap_content,
+        governor.spent_tokens - spent_tokens, time.monotonic() - start
+    )
+    
+    # 実際に使ったモデルと生成の経路を記録
+    routes = {kind: route for kind, route in routes.items() if route}
+    if routes:
+        result.set('cascade', routes)
+
+# 同じユーザーの複数のアイデアを1回のリクエストでまとめて処理
+# 応答を分けられなかった場合はFalseを返す（アイデアごとの処理に切り替える）
+def process_digest(store, ideas, decision, governor):
+    print(f"Processing digest of {len(ideas)} ideas for user: {ideas[0].user_id} (level: {LEVEL_NAMES[decision.level]}, model: {decision.model})")
+    include_mindmap = not decision.skip_mindmap
+    spent_tokens = governor.spent_tokens
+    start = time.monotonic()
+    
+    try:
+        parsed = create_chat_completion(
+            digest_kind(include_mindmap),
+            decision.model,
+            build_digest_messages(ideas, include_mindmap),
+            max_tokens=digest_max_tokens(len(ideas), include_mindmap),
+            governor=governor,
+            count=len(ideas),
+            parse=lambda text: parse_digest_response(text, len(ideas), include_mindmap)
+        )
+    except Exception as e:
+        print(f"Error processing digest: {e}")
+        return False
+    
+    if parsed is None:
+        print("Failed to split digest response, falling back to per-idea processing")
+        return False
+    enhancements, mindmap_content = parsed
+    
+    # 結果はアイデアごとに保存し、同じダイジェストIDで翌朝まとめて送信する
+    digest_id = f"digest_{ideas[0].idea_id[5:]}"
+    actual_tokens = (governor.spent_tokens - spent_tokens) / len(ideas)
+    actual_seconds = (time.monotonic() - start) / len(ideas)
+    for idea, enhanced_content in zip(ideas, enhancements):
+        result = save_result(
+            store, idea, decision, enhanced_content, mindmap_content,
+            int(actual_tokens), actual_seconds
+        )
+        result.set('digest_id', digest_id)
+        result.get('governor')['digest_size'] = len(ideas)
+    return True
+
+# ダイジェストモードでアイデアを処理
+# 優先度の高いアイデアから順に、同じユーザー・同じ処理内容の残りのアイデアを1回のリクエストに収まるだけまとめる
+# ダイジェストに失敗したユーザーは、その夜は残りのアイデアもすべてアイデアごとに処理する
+def process_digests(store, queue, governor, cascade):
+    # ユーザーごとの未処理のアイデア（優先度の高い順、先頭は常にそのユーザーの次に処理するアイデア）
+    user_queues = {}
+    for idea in queue:
+        user_queues.setdefault(idea.user_id, deque()).append(idea)
+    done = set()
+    digest_failed = set()
+    
+    for i, idea in enumerate(queue):
+        if idea.idea_id in done:
+            continue
+        user_queue = user_queues[idea.user_id]
+        
+        # 前のアイデアを処理した場合は、実績を反映して残りのアイデアを再計画
+        decision = governor.decide(queue, i, done)
+        
+        if decision.deferred:
+            defer_idea(idea, decision)
+            user_queue.popleft()
+            continue
+        
+        # 処理内容は優先度の低いアイデアほど安価になるため、同じ段階のアイデアはユーザーごとに先頭から連続する
+        chunk = [idea]
+        if idea.user_id not in digest_failed:
+            group = itertools.takewhile(
+                lambda other: governor.decisions[other.idea_id].level == decision.level, user_queue
+            )
+            chunk = take_digest_chunk(group, not decision.skip_mindmap)
+        
+        if len(chunk) > 1:
+            if process_digest(store, chunk, decision, governor):
+                for other in chunk:
+                    user_queue.popleft()
+                    done.add(other.idea_id)
+                continue
+            digest_failed.add(idea.user_id)
+        
+        process_idea(store, idea, decision, governor, cascade)
+        user_queue.popleft()
+
+# 全文検索インデックスに新しいアイデア・結果を反映（失敗しても夜間処理は続ける）
+def update_search_index(store):
+    try:
+        with SearchIndex() as index:
+            count = index.sync(store)
+        print(f"Search index updated: {count} ideas")
+    except Exception as e:
+        print(f"Error updating search index: {e}")
+
 # メイン処理
 def main():
     print("Starting idea processing...")
     
+    # チェックアウト済みのデータベースに未処理のアイデアがなければ、GitHubから取得せずに終了
+    local_store = read_local_store()
+    if local_store is not None and not local_store.unprocessed_ideas():
+        print("No unprocessed ideas found")
+        return
+    del local_store
+    
     # データベースを取得
-    database, sha = get_database()
-    if not database or not sha:
+    store, sha = get_database()
+    if store is None or not sha:
         print("Failed to fetch database")
         return
     
     # 未処理のアイデアを検索
-    unprocessed_ideas = {
-        idea_id: idea_data
-        for idea_id, idea_data in database.get('ideas', {}).items()
-        if not idea_data.get('processed', False)
-    }
+    unprocessed_ideas = store.unprocessed_ideas()
     
     if not unprocessed_ideas:
         print("No unprocessed ideas found")
@@ -132,36 +352,41 @@ def main():
     
     print(f"Found {len(unprocessed_ideas)} unprocessed ideas")
     
+    # トークン予算・締め切りに収まるように処理内容を計画（優先度の高い順に処理）
+    runs = load_run_metrics()
+    governor = NightGovernor(history=runs, cascade=CASCADE_ENABLED, digest=DIGEST_MODE)
+    cascade = CascadeStats()
+    queue = prioritize(unprocessed_ideas)
+    
     # 各アイデアを処理
-    for idea_id, idea_data in unprocessed_ideas.items():
-        print(f"Processing idea: {idea_id}")
-        
-        # アイデアの内容
-        idea_content = idea_data.get('content', '')
-        
-        # アイデアをブラッシュアップ
-        enhanced_content = enhance_idea(idea_content)
-        
-        # マインドマップを生成
-        mindmap_content = generate_mindmap(idea_content)
-        
-        # 結果を保存
-        result_id = f"result_{idea_id[5:]}"  # idea_20250406_001 -> result_20250406_001
-        
-        database.setdefault('results', {})[result_id] = {
-            'idea_id': idea_id,
-            'enhanced_content': enhanced_content,
-            'mindmap_content': mindmap_content,
-            'created_at': datetime.now().isoformat(),
-            'sent': False
-        }
-        
-        # アイデアを処理済みにマーク
-        database['ideas'][idea_id]['processed'] = True
+    if DIGEST_MODE:
+        # ユーザーごとにアイデアをまとめて処理
+        process_digests(store, queue, governor, cascade)
+    else:
+        for i, idea in enumerate(queue):
+            # 前のアイデアを処理した場合は、実績を反映して残りのアイデアを再計画
+            decision = governor.decide(queue, i)
+            
+            if decision.deferred:
+                defer_idea(idea, decision)
+            else:
+                process_idea(store, idea, decision, governor, cascade)
+    
+    # 実行記録を保存（次回以降の見積もりに使用）
+    run = governor.run_metrics()
+    run['cascade'] = cascade.run_metrics()
+    print(f"Run summary: {run['decisions']}, {run['spent_tokens']} tokens, {run['elapsed_seconds']}s")
+    for kind, stats in run['cascade'].items():
+        print(f"Cascade {kind}: {stats['accepted']} accepted, {stats['escalated']} escalated, {stats['complex']} complex "
+              f"(escalation rate {stats['escalation_rate']:.0%}, saved {stats['saved_seconds']}s)")
+    save_run_metrics(runs + [run])
     
     # データベースを更新
-    if update_database(database, sha):
+    if update_database(store.to_dict(), sha):
         print("Database updated successfully")
+        
+        # データベースに保存された結果だけをインデックスに反映
+        update_search_index(store)
     else:
         print("Failed to update database")
 
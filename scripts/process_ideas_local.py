@@ -1,26 +1,33 @@
 import os
 import json
-import openai
-from datetime import datetime
 import sys
-from dotenv import load_dotenv
+from records import RecordStore
 
-# .envファイルから環境変数を読み込む
-load_dotenv()
+# openai・dotenvは読み込みが重いため、実際に処理が必要になった時点でインポートする
 
-# 環境変数
-OPENAI_API_KEY = os.environ.get('OPENAI_API_KEY')
+# OpenAIクライアントを遅延読み込み
+_openai = None
 
-# OpenAI API設定
-openai.api_key = OPENAI_API_KEY
+def get_openai():
+    global _openai
+    if _openai is None:
+        import openai
+        from dotenv import load_dotenv
 
-print(f"Using OpenAI API Key: {OPENAI_API_KEY[:5]}...{OPENAI_API_KEY[-5:]}")
+        # .envファイルから環境変数を読み込む
+        load_dotenv()
+        openai_api_key = os.environ.get('OPENAI_API_KEY', '')
+        print(f"Using OpenAI API Key: {openai_api_key[:5]}...{openai_api_key[-5:]}")
+
+        openai.api_key = openai_api_key
+        _openai = openai
+    return _openai
 
 # ローカルデータベースを読み込む
 def read_database():
     try:
         with open('data/database.json', 'r', encoding='utf-8') as f:
-            return json.load(f)
+            return RecordStore.from_json(f.read())
     except Exception as e:
         print(f"Error reading database: {e}")
         return None
@@ -38,7 +45,7 @@ def save_database(database):
 # アイデアをブラッシュアップ
 def enhance_idea(idea_content):
     try:
-        response = openai.ChatCompletion.create(
+        response = get_openai().ChatCompletion.create(
             model="gpt-4",
             messages=[
                 {"role": "system", "content": "あなたは創造的なアイデアを発展させるアシスタントです。ユーザーのアイデアを分析し、それを発展させ、より具体的で実用的なものにしてください。"},
@@ -55,7 +62,7 @@ def enhance_idea(idea_content):
 # マインドマップを生成
 def generate_mindmap(idea_content):
     try:
-        response = openai.ChatCompletion.create(
+        response = get_openai().ChatCompletion.create(
             model="gpt-4",
             messages=[
                 {"role": "system", "content": "あなたはアイデアからテキスト形式のマインドマップを作成するアシスタントです。中心となるアイデアから派生する概念を階層的に表現してください。"},
@@ -74,17 +81,13 @@ def main():
     print("Starting idea processing...")
     
     # データベースを取得
-    database = read_database()
-    if not database:
+    store = read_database()
+    if store is None:
         print("Failed to read database")
         return
     
     # 未処理のアイデアを検索
-    unprocessed_ideas = {
-        idea_id: idea_data
-        for idea_id, idea_data in database.get('ideas', {}).items()
-        if not idea_data.get('processed', False)
-    }
+    unprocessed_ideas = store.unprocessed_ideas()
     
     if not unprocessed_ideas:
         print("No unprocessed ideas found")
@@ -93,34 +96,23 @@ def main():
     print(f"Found {len(unprocessed_ideas)} unprocessed ideas")
     
     # 各アイデアを処理
-    for idea_id, idea_data in unprocessed_ideas.items():
-        print(f"Processing idea: {idea_id}")
-        
-        # アイデアの内容
-        idea_content = idea_data.get('content', '')
+    for idea in unprocessed_ideas:
+        print(f"Processing idea: {idea.idea_id}")
         
         # アイデアをブラッシュアップ
-        enhanced_content = enhance_idea(idea_content)
+        enhanced_content = enhance_idea(idea.content)
         
         # マインドマップを生成
-        mindmap_content = generate_mindmap(idea_content)
+        mindmap_content = generate_mindmap(idea.content)
         
         # 結果を保存
-        result_id = f"result_{idea_id[5:]}"  # idea_20250406_001 -> result_20250406_001
-        
-        database.setdefault('results', {})[result_id] = {
-            'idea_id': idea_id,
-            'enhanced_content': enhanced_content,
-            'mindmap_content': mindmap_content,
-            'created_at': datetime.now().isoformat(),
-            'sent': False
-        }
+        store.add_result(idea, enhanced_content, mindmap_content)
         
         # アイデアを処理済みにマーク
-        database['ideas'][idea_id]['processed'] = True
+        idea.processed = True
     
     # データベースを更新
-    if save_database(database):
+    if save_database(store.to_dict()):
         print("Database updated successfully")
     else:
         print("Failed to update database")
@@ -0,0 +1,513 @@
+import gc
+import os
+import sys
+import json
+from array import array
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Optional
+
+# データベースのアイデア・結果を保持するレコード層
+# JSONの入れ子のdictをそのまま保持すると、レコードごとにdict・ユーザーID・タイムスタンプ文字列が
+# 重複して確保されるため、よくある形のレコードはフィールドごとの列にまとめ、取得したものだけを
+# __slots__付きのdataclassに変換してメモリ使用量を抑える
+
+# タイムスタンプの書式
+TS_UTC_MILLIS = 0  # 2025-04-06T11:54:05.972Z（サーバーが書き込む形式）
+TS_NAIVE = 1       # 2025-04-06T21:15:15.098764（datetime.now().isoformat()の形式）
+TS_RAW = 2         # 上記以外・null・キーがない場合（元の値をextraの補助情報に保持する）
+
+_EPOCH = datetime(1970, 1, 1)
+_MICROSECOND = timedelta(microseconds=1)
+
+# チェックアウト済みのデータベースのパス（GitHub Actionsではリポジトリをチェックアウトしてから実行する）
+LOCAL_DATABASE_PATH = os.environ.get('LOCAL_DATABASE_PATH', 'data/database.json')
+
+
+# キーの並び順を共有するためのキャッシュ
+_layouts = {}
+
+IDEA_FIELDS = ('user_id', 'content', 'created_at', 'processed')
+RESULT_FIELDS = ('idea_id', 'enhanced_content', 'mindmap_content', 'created_at', 'sent')
+
+# キーの並び順を共有タプルとして取得
+def _layout(keys):
+    keys = tuple(keys)
+    return _layouts.setdefault(keys, keys)
+
+# 書式どおりの区切り文字が並んでいるか（この場合は元の文字列に戻せることが保証される）
+def _is_canonical(value):
+    return (
+        value[4] == '-' and value[7] == '-' and value[10] == 'T'
+        and value[13] == ':' and value[16] == ':'
+    )
+
+# ISO形式のタイムスタンプを (エポックからのマイクロ秒, 書式) に変換
+def parse_timestamp(value):
+    # よく使われる書式は文字列への再変換による確認を省略する
+    if isinstance(value, str):
+        length = len(value)
+        if length == 24 and value[23] == 'Z' and value[19] == '.' and _is_canonical(value):
+            return (datetime.fromisoformat(value[:-1]) - _EPOCH) // _MICROSECOND, TS_UTC_MILLIS
+        if (length == 19 or (length == 26 and value[19] == '.' and value[20:] != '000000')) and _is_canonical(value):
+            return (datetime.fromisoformat(value) - _EPOCH) // _MICROSECOND, TS_NAIVE
+
+    try:
+        if value.endswith('Z'):
+            dt = datetime.fromisoformat(value[:-1])
+            fmt = TS_UTC_MILLIS
+        else:
+            dt = datetime.fromisoformat(value)
+            fmt = TS_NAIVE
+    except (AttributeError, TypeError, ValueError):
+        return 0, TS_RAW
+
+    if dt.tzinfo is not None:
+        return 0, TS_RAW
+
+    micros = (dt - _EPOCH) // _MICROSECOND
+    # 元の文字列に戻せない場合は変換しない
+    if format_timestamp(micros, fmt) != value:
+        return 0, TS_RAW
+    return micros, fmt
+
+# エポックからのマイクロ秒をISO形式のタイムスタンプに変換
+def format_timestamp(micros, fmt):
+    dt = _EPOCH + timedelta(microseconds=micros)
+    if fmt == TS_UTC_MILLIS:
+        return f"{dt.strftime('%Y-%m-%dT%H:%M:%S')}.{dt.microsecond // 1000:03d}Z"
+    return dt.isoformat()
+
+# 現在時刻をエポックからのマイクロ秒で取得（datetime.now().isoformat()と同じローカル時刻）
+def now_timestamp():
+    return (datetime.now() - _EPOCH) // _MICROSECOND
+
+# キーがないことを表す値
+_ABSENT = object()
+
+# extraに保持する補助情報（キーの並び順・タイムスタンプの書式・元の値）のキー
+# JSONのキーは文字列のため、データの項目と重なることはない
+_META = ('meta',)
+
+# 既知のフィールドの値を型どおりに揃える（null・キーがない場合・型の違う値）
+def _normalize(kind, value):
+    if kind is bool:
+        return value is not _ABSENT and bool(value)
+    if value is None or value is _ABSENT:
+        return ''
+    return str(value)
+
+# 既知のフィールドとextraをキーの並び順どおりにdictへ戻す
+def _build_dict(known, extra, layout):
+    data = {}
+    for key in layout or ():
+        if key in known:
+            data[key] = known[key]
+        elif extra and key in extra:
+            data[key] = extra[key]
+    for key, value in known.items():
+        if key not in data:
+            data[key] = value
+    for key, value in (extra or {}).items():
+        if key is not _META and key not in data:
+            data[key] = value
+    return data
+
+# アイデア・結果の共通処理
+# レコードごとのスロットは値だけにし、よくある形と違う場合（キーの並び順・タイムスタンプの書式・nullなどの元の値）は
+# extraの補助情報に残して、保存時に元のとおりに戻す
+class _Record:
+    __slots__ = ()
+
+    # 保存時のフィールドの並び順と型（Noneはタイムスタンプ）
+    FIELDS = ()
+    # よくあるタイムスタンプの書式（これ以外の場合だけ補助情報に残す）
+    TIMESTAMP_FORMAT = TS_NAIVE
+
+    # 一般的な形のdictから変換
+    @classmethod
+    def _from_dict(cls, record_id, data):
+        values = [record_id]
+        names = set()
+        raw = {}
+        timestamp_format = cls.TIMESTAMP_FORMAT
+        for name, kind in cls.FIELDS:
+            names.add(name)
+            value = data.get(name, _ABSENT)
+            if kind is None:
+                micros, timestamp_format = parse_timestamp(value)
+                if timestamp_format == TS_RAW:
+                    raw[name] = value
+                values.append(micros)
+            elif type(value) is kind:
+                values.append(value)
+            else:
+                raw[name] = value
+                values.append(_normalize(kind, value))
+
+        extra = {key: value for key, value in data.items() if key not in names}
+        meta = {}
+        if raw:
+            meta['raw'] = raw
+        if timestamp_format not in (cls.TIMESTAMP_FORMAT, TS_RAW):
+            meta['format'] = timestamp_format
+        keys = tuple(data)
+        expected = tuple(name for name, _ in cls.FIELDS if name in data) + tuple(extra)
+        if keys != expected:
+            meta['layout'] = _layout(keys)
+        if meta:
+            extra[_META] = meta
+        return cls(*values, extra or None)
+
+    def _meta(self):
+        if self.extra is None:
+            return None
+        return self.extra.get(_META)
+
+    # 読み込んだときのタイムスタンプの書式
+    @property
+    def created_at_format(self):
+        meta = self._meta()
+        if meta is None:
+            return self.TIMESTAMP_FORMAT
+        if 'created_at' in meta.get('raw', ()):
+            return TS_RAW
+        return meta.get('format', self.TIMESTAMP_FORMAT)
+
+    # 保存される形式のタイムスタンプ（文字列でない場合は空文字）
+    def created_at_text(self):
+        if self.created_at_format == TS_RAW:
+            value = self._meta()['raw']['created_at']
+            return value if isinstance(value, str) else ''
+        return format_timestamp(self.created_at, self.created_at_format)
+
+    # 既知のフィールド以外を取得
+    def get(self, key, default=None):
+        if self.extra is None:
+            return default
+        return self.extra.get(key, default)
+
+    # 既知のフィールド以外を設定
+    def set(self, key, value):
+        if self.extra is None:
+            self.extra = {}
+        self.extra[key] = value
+
+    def to_dict(self):
+        meta = self._meta() or {}
+        raw = meta.get('raw', {})
+        known = {}
+        for name, kind in self.FIELDS:
+            value = getattr(self, name)
+            if name in raw:
+                # 読み込んだ後に変更されていなければ元の値（キーがない場合は省略）に戻す
+                original = raw[name]
+                if value == (0 if kind is None else _normalize(kind, original)):
+                    if original is not _ABSENT:
+                        known[name] = original
+                    continue
+                if kind is None:
+                    value = format_timestamp(value, meta.get('format', self.TIMESTAMP_FORMAT))
+            elif kind is None:
+                value = format_timestamp(value, meta.get('format', self.TIMESTAMP_FORMAT))
+            known[name] = value
+        return _build_dict(known, self.extra, meta.get('layout'))
+
+@dataclass(slots=True)
+class Idea(_Record):
+    idea_id: str
+    user_id: str
+    content: str
+    created_at: int = 0
+    processed: bool = False
+    extra: Optional[dict] = None
+
+    FIELDS = (('user_id', str), ('content', str), ('created_at', None), ('processed', bool))
+    # アイデアはサーバーが書き込む
+    TIMESTAMP_FORMAT = TS_UTC_MILLIS
+
+    @classmethod
+    def from_dict(cls, idea_id, data):
+        idea = cls._from_dict(idea_id, data)
+        idea.user_id = sys.intern(idea.user_id)
+        return idea
+
+    # サーバーが書き込む形であれば、列に追加する値を返す（それ以外はNone）
+    @classmethod
+    def row_values(cls, data):
+        if tuple(data) != IDEA_FIELDS:
+            return None
+        user_id = data['user_id']
+        content = data['content']
+        processed = data['processed']
+        if type(user_id) is str and type(content) is str and type(processed) is bool:
+            created_at, created_at_format = parse_timestamp(data['created_at'])
+            if created_at_format == TS_UTC_MILLIS:
+                return (sys.intern(user_id), content, created_at, processed)
+        return None
+
+@dataclass(slots=True)
+class Result(_Record):
+    result_id: str
+    idea_id: str
+    enhanced_content: str = ''
+    mindmap_content: str = ''
+    created_at: int = 0
+    sent: bool = False
+    extra: Optional[dict] = None
+
+    FIELDS = (
+        ('idea_id', str), ('enhanced_content', str), ('mindmap_content', str),
+        ('created_at', None), ('sent', bool)
+    )
+    # 結果は夜間処理（datetime.now().isoformat()）が書き込む
+    TIMESTAMP_FORMAT = TS_NAIVE
+
+    @classmethod
+    def from_dict(cls, result_id, data):
+        return cls._from_dict(result_id, data)
+
+    # 既知のフィールドだけの形であれば、列に追加する値を返す（それ以外はNone）
+    @classmethod
+    def row_values(cls, data):
+        if tuple(data) != RESULT_FIELDS:
+            return None
+        idea_id = data['idea_id']
+        enhanced_content = data['enhanced_content']
+        mindmap_content = data['mindmap_content']
+        sent = data['sent']
+        if (type(idea_id) is str and type(enhanced_content) is str
+                and type(mindmap_content) is str and type(sent) is bool):
+            created_at, created_at_format = parse_timestamp(data['created_at'])
+            if created_at_format == TS_NAIVE:
+                return (idea_id, enhanced_content, mindmap_content, created_at, sent)
+        return None
+
+# フィールドの型ごとの列（文字列はlist、タイムスタンプは64ビット整数の配列、真偽値はbytearray）
+def _new_column(kind):
+    if kind is None:
+        return array('q')
+    if kind is bool:
+        return bytearray()
+    return []
+
+# レコードIDからアイデア・結果への対応（RecordStore.ideas・RecordStore.results）
+# よくある形のレコードはオブジェクトを作らず、フィールドごとの列に1行として持ち、rowsには行番号を入れる
+# 取得したレコードだけをIdea・Resultに変換してrowsの行番号と置き換えるため、変換したレコードへの変更は保存時に反映される
+class RecordTable:
+    __slots__ = ('record_type', 'rows', 'columns', '_appends')
+
+    def __init__(self, record_type):
+        self.record_type = record_type
+        self.rows = {}
+        self.columns = tuple(_new_column(kind) for _, kind in record_type.FIELDS)
+        self._appends = tuple(column.append for column in self.columns)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __contains__(self, record_id):
+        return record_id in self.rows
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def keys(self):
+        return self.rows.keys()
+
+    # 列に行を追加し、行番号を返す
+    def _append_row(self, values):
+        for append, value in zip(self._appends, values):
+            append(value)
+        return len(self.columns[0]) - 1
+
+    # 行をレコードに変換
+    def _record(self, record_id, row):
+        values = [
+            bool(column[row]) if kind is bool else column[row]
+            for (_, kind), column in zip(self.record_type.FIELDS, self.columns)
+        ]
+        return self.record_type(record_id, *values)
+
+    # 行を保存用のdictに変換
+    def _row_dict(self, row):
+        data = {}
+        for (name, kind), column in zip(self.record_type.FIELDS, self.columns):
+            if kind is None:
+                data[name] = format_timestamp(column[row], self.record_type.TIMESTAMP_FORMAT)
+            elif kind is bool:
+                data[name] = bool(column[row])
+            else:
+                data[name] = column[row]
+        return data
+
+    # JSONのdictからレコードを追加（よくある形は列に、それ以外はレコードとして持つ）
+    def add_dict(self, record_id, data):
+        values = self.record_type.row_values(data)
+        if values is None:
+            self.rows[record_id] = self.record_type.from_dict(record_id, data)
+        else:
+            self.rows[record_id] = self._append_row(values)
+
+    # レコードを取得（列に持っている場合はレコードに変換して置き換える）
+    def __getitem__(self, record_id):
+        record = self.rows[record_id]
+        if type(record) is int:
+            record = self.rows[record_id] = self._record(record_id, record)
+        return record
+
+    def get(self, record_id, default=None):
+        if record_id not in self.rows:
+            return default
+        return self[record_id]
+
+    def __setitem__(self, record_id, record):
+        self.rows[record_id] = record
+
+    def values(self):
+        for record_id in self.rows:
+            yield self[record_id]
+
+    def items(self):
+        for record_id in self.rows:
+            yield record_id, self[record_id]
+
+    # すべてのレコードを読み取り専用で走査する（列に持っている行は一時的なレコードとして返し、置き換えない）
+    # 検索インデックスの同期など、全件を読むだけの処理でメモリが増えないようにする
+    def scan(self):
+        for record_id, record in self.rows.items():
+            if type(record) is int:
+                record = self._record(record_id, record)
+            yield record_id, record
+
+    # 真偽値のフィールド（processed・sent）がFalseのレコードの一覧（レコードに変換して置き換える）
+    def where_false(self, name):
+        column = self.columns[[field for field, _ in self.record_type.FIELDS].index(name)]
+        return [
+            self[record_id] for record_id, record in self.rows.items()
+            if not (column[record] if type(record) is int else getattr(record, name))
+        ]
+
+    # 保存用のdictに戻す
+    def to_dict(self):
+        return {
+            record_id: self._row_dict(record) if type(record) is int else record.to_dict()
+            for record_id, record in self.rows.items()
+        }
+
+class RecordStore:
+    __slots__ = ('users', 'ideas', 'results', 'extra')
+
+    def __init__(self, users=None, ideas=None, results=None, extra=None):
+        self.users = users if users is not None else {}
+        self.ideas = ideas if ideas is not None else RecordTable(Idea)
+        self.results = results if results is not None else RecordTable(Result)
+        self.extra = extra
+
+    # データベース（dict）からレコードを読み込む
+    @classmethod
+    def from_dict(cls, database):
+        store = cls(users=database.get('users', {}))
+        for idea_id, data in database.get('ideas', {}).items():
+            store.ideas.add_dict(idea_id, data)
+        for result_id, data in database.get('results', {}).items():
+            store.results.add_dict(result_id, data)
+        store._finish(database)
+        return store
+
+    # データベースのJSON文字列からレコードを読み込む
+    # よくある形のアイデア・結果は解析中に列へ追加するため、すべてのdictが同時に存在することがなく、ピークのメモリが小さくなる
+    @classmethod
+    def from_json(cls, text):
+        store = cls()
+        ideas = store.ideas
+        results = store.results
+
+        # よくある形のアイデア・結果のdictを、列に追加した行番号に置き換える
+        def hook(data):
+            size = len(data)
+            if size == len(IDEA_FIELDS):
+                values = Idea.row_values(data)
+                if values is not None:
+                    return ideas._append_row(values)
+            elif size == len(RESULT_FIELDS):
+                values = Result.row_values(data)
+                if values is not None:
+                    return results._append_row(values)
+            return data
+
+        # 解析中に作られる大量のオブジェクトで世代別GCが繰り返し走らないよう、解析の間は止める（循環参照は作られない）
+        enabled = gc.isenabled()
+        gc.disable()
+        try:
+            database = json.loads(text, object_hook=hook)
+        finally:
+            if enabled:
+                gc.enable()
+
+        store.users = database.get('users', {})
+        for table, records in ((ideas, database.get('ideas', {})), (results, database.get('results', {}))):
+            for record_id, record in records.items():
+                if type(record) is int:
+                    table.rows[record_id] = record
+                else:
+                    table.add_dict(record_id, record)
+        store._finish(database)
+        return store
+
+    # 読み込みの仕上げ（結果のアイデアIDはアイデア側の文字列を共有し、ideas・results・users以外のキーを保持する）
+    def _finish(self, database):
+        idea_ids = {idea_id: idea_id for idea_id in self.ideas}
+        column = self.results.columns[0]
+        for record in self.results.rows.values():
+            if type(record) is int:
+                column[record] = idea_ids.get(column[record], column[record])
+            else:
+                record.idea_id = idea_ids.get(record.idea_id, record.idea_id)
+
+        extra = {
+            key: value for key, value in database.items()
+            if key not in ('users', 'ideas', 'results')
+        }
+        self.extra = extra or None
+
+    # レコードをデータベース（dict）に戻す
+    def to_dict(self):
+        database = {
+            'users': self.users,
+            'ideas': self.ideas.to_dict(),
+            'results': self.results.to_dict()
+        }
+        database.update(self.extra or {})
+        return database
+
+    # 未処理のアイデアの一覧を返す
+    def unprocessed_ideas(self):
+        return self.ideas.where_false('processed')
+
+    # 未送信の結果の一覧を返す
+    def unsent_results(self):
+        return self.results.where_false('sent')
+
+    # 処理結果を追加
+    def add_result(self, idea, enhanced_content, mindmap_content):
+        result_id = f"result_{idea.idea_id[5:]}"  # idea_20250406_001 -> result_20250406_001
+        result = Result(
+            result_id=result_id,
+            idea_id=idea.idea_id,
+            enhanced_content=enhanced_content,
+            mindmap_content=mindmap_content,
+            created_at=now_timestamp(),
+            sent=False
+        )
+        self.results[result_id] = result
+        return result
+
+# チェックアウト済みのデータベースを読み込む（ない場合・読み込めない場合はNone）
+# 処理対象があるかをGitHub APIで取得する前に確認するために使う
+def read_local_store(path=LOCAL_DATABASE_PATH):
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return RecordStore.from_json(f.read())
+    except (OSError, ValueError):
+        return None
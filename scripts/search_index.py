@@ -0,0 +1,371 @@
+import os
+import re
+import sys
+import sqlite3
+import argparse
+import unicodedata
+from array import array
+from dataclasses import dataclass
+from typing import Optional
+from records import RecordStore
+
+# 過去のアイデア・ブラッシュアップの全文検索インデックス
+# アイデアの内容（content）と結果のブラッシュアップ（enhanced_content）を対象に、
+# 日本語は文字バイグラム、英数字は単語を単位とした転置インデックスをSQLiteのファイルに保存する
+# 夜間処理のたびに追加・更新されたアイデアだけを差分でインデックスに反映する
+
+# インデックスのファイルパス
+SEARCH_INDEX_PATH = os.environ.get('SEARCH_INDEX_PATH', 'data/search_index.sqlite3')
+
+# インデックスの形式のバージョン（トークン化の方法を変えた場合は上げて作り直す）
+SEARCH_INDEX_VERSION = 1
+
+# 検索対象のフィールド
+FIELD_CONTENT = 1
+FIELD_ENHANCED = 2
+
+FIELD_NAMES = {
+    FIELD_CONTENT: 'content',
+    FIELD_ENHANCED: 'enhanced_content',
+}
+
+# 英数字の単語と、それ以外の文字（かな・漢字など）の連続
+TOKEN_PATTERN = re.compile(r'[a-z0-9]+|(?:(?![a-z0-9_])\w)+')
+
+# スニペットとして前後に表示する文字数
+SNIPPET_CONTEXT = 30
+
+# 検索結果の本文を確認するときに一度に読み込む件数
+VERIFY_BATCH_SIZE = 200
+
+# 初回の作成などで多数のアイデアを反映する場合に、ポスティングをまとめて書き込む件数
+SYNC_BATCH_SIZE = 5000
+
+# ポスティングはトークン・ユーザーごとにドキュメントIDの配列（昇順、リトルエンディアンの32ビット整数）として保存する
+# 新しいドキュメントほどIDが大きいため、追加は配列の末尾への追記だけで済む
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS users (
+    user_no INTEGER PRIMARY KEY,
+    user_id TEXT NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS docs (
+    doc_id INTEGER PRIMARY KEY,
+    idea_id TEXT NOT NULL UNIQUE,
+    result_id TEXT,
+    user_no INTEGER NOT NULL,
+    created_at_text TEXT NOT NULL,
+    content TEXT NOT NULL,
+    enhanced_content TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS postings (
+    token TEXT NOT NULL,
+    user_no INTEGER NOT NULL,
+    doc_ids BLOB NOT NULL,
+    PRIMARY KEY (token, user_no)
+) WITHOUT ROWID;
+"""
+
+# 表記ゆれを揃える（全角英数字・半角カナなどを統一し、英字は小文字にする）
+def normalize_text(text):
+    return unicodedata.normalize('NFKC', text or '').lower()
+
+# テキストをトークンに分割
+# 英数字は単語単位、それ以外の文字の連続は2文字ずつ（バイグラム）に分け、
+# 連続の最後の1文字も加えておく（1文字での検索を前方一致で行えるようにするため）
+def tokenize(text):
+    tokens = set()
+    for match in TOKEN_PATTERN.finditer(normalize_text(text)):
+        word = match.group()
+        if word[0] < '\x80':
+            tokens.add(word)
+            continue
+        for i in range(len(word) - 1):
+            tokens.add(word[i:i + 2])
+        tokens.add(word[-1])
+    return tokens
+
+# 検索語をトークンに分割
+# (トークン, 前方一致で検索するか) の組を返す
+def query_tokens(term):
+    tokens = []
+    for match in TOKEN_PATTERN.finditer(term):
+        word = match.group()
+        if word[0] < '\x80':
+            # 英数字は単語の前方一致（「app」で「apple」にも一致する）
+            tokens.append((word, True))
+        elif len(word) == 1:
+            tokens.append((word, True))
+        else:
+            tokens.extend((word[i:i + 2], False) for i in range(len(word) - 1))
+    return tokens
+
+# ドキュメントのトークン（アイデアの内容とブラッシュアップの両方）
+def document_tokens(content, enhanced_content):
+    return tokenize(content) | tokenize(enhanced_content)
+
+# ドキュメントIDの配列とバイト列の変換
+def pack_doc_ids(doc_ids):
+    packed = array('I', doc_ids)
+    if sys.byteorder == 'big':
+        packed.byteswap()
+    return packed.tobytes()
+
+def unpack_doc_ids(data):
+    doc_ids = array('I')
+    doc_ids.frombytes(data)
+    if sys.byteorder == 'big':
+        doc_ids.byteswap()
+    return doc_ids
+
+# 一致した箇所の前後を切り出す
+def make_snippet(text, term):
+    position = text.find(term)
+    if position < 0:
+        return ''
+    start = max(0, position - SNIPPET_CONTEXT)
+    end = min(len(text), position + len(term) + SNIPPET_CONTEXT)
+    snippet = text[start:end].replace('\n', ' ')
+    return f"{'…' if start > 0 else ''}{snippet}{'…' if end < len(text) else ''}"
+
+@dataclass(slots=True)
+class SearchHit:
+    idea_id: str
+    result_id: Optional[str]
+    user_id: str
+    created_at: str
+    matched_fields: tuple
+    snippet: str
+
+class SearchIndex:
+    def __init__(self, path=SEARCH_INDEX_PATH):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript(SCHEMA)
+        self._check_version()
+        self.user_numbers = dict(self.connection.execute("SELECT user_id, user_no FROM users"))
+        self.pending = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.connection.close()
+
+    # 形式のバージョンが異なるインデックスは空にして作り直す
+    def _check_version(self):
+        row = self.connection.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+        if row and int(row[0]) == SEARCH_INDEX_VERSION:
+            return
+        with self.connection:
+            if row:
+                print(f"Search index version changed ({row[0]} -> {SEARCH_INDEX_VERSION}), rebuilding")
+            for table in ('postings', 'docs', 'users'):
+                self.connection.execute(f"DELETE FROM {table}")
+            self.connection.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES ('version', ?)",
+                (str(SEARCH_INDEX_VERSION),)
+            )
+
+    # ユーザーIDの番号（ポスティングには番号で保存する）
+    def _user_no(self, user_id):
+        user_no = self.user_numbers.get(user_id)
+        if user_no is None:
+            user_no = self.connection.execute(
+                "INSERT INTO users (user_id) VALUES (?)", (user_id,)
+            ).lastrowid
+            self.user_numbers[user_id] = user_no
+        return user_no
+
+    # インデックス済みのアイデアとその結果ID
+    def indexed(self):
+        return dict(self.connection.execute("SELECT idea_id, result_id FROM docs"))
+
+    # ドキュメントをポスティングから削除
+    def _remove(self, doc_id, user_no, tokens):
+        for token in tokens:
+            row = self.connection.execute(
+                "SELECT doc_ids FROM postings WHERE token = ? AND user_no = ?", (token, user_no)
+            ).fetchone()
+            if not row:
+                continue
+            doc_ids = [other for other in unpack_doc_ids(row[0]) if other != doc_id]
+            if doc_ids:
+                self.connection.execute(
+                    "UPDATE postings SET doc_ids = ? WHERE token = ? AND user_no = ?",
+                    (pack_doc_ids(doc_ids), token, user_no)
+                )
+            else:
+                self.connection.execute(
+                    "DELETE FROM postings WHERE token = ? AND user_no = ?", (token, user_no)
+                )
+
+    # 書き込み待ちのポスティングを配列の末尾に追記
+    def _flush(self):
+        self.connection.executemany(
+            "INSERT INTO postings (token, user_no, doc_ids) VALUES (?, ?, ?) "
+            "ON CONFLICT (token, user_no) DO UPDATE SET doc_ids = CAST(doc_ids || excluded.doc_ids AS BLOB)",
+            ((token, user_no, pack_doc_ids(doc_ids)) for (token, user_no), doc_ids in self.pending.items())
+        )
+        self.pending = {}
+
+    # アイデア（と結果）をインデックスに追加・更新（トランザクションは呼び出し側で確定する）
+    def _add(self, idea, result=None):
+        enhanced_content = result.enhanced_content if result else ''
+        created_at_text = idea.created_at_text()
+
+        # 登録済みの場合は以前のドキュメントを削除し、新しいIDで登録し直す（配列を昇順に保つため）
+        row = self.connection.execute(
+            "SELECT doc_id, user_no, content, enhanced_content FROM docs WHERE idea_id = ?",
+            (idea.idea_id,)
+        ).fetchone()
+        if row:
+            doc_id, user_no, content, old_enhanced = row
+            self._flush()
+            self._remove(doc_id, user_no, document_tokens(content, old_enhanced))
+            self.connection.execute("DELETE FROM docs WHERE doc_id = ?", (doc_id,))
+
+        user_no = self._user_no(idea.user_id)
+        doc_id = self.connection.execute(
+            "INSERT INTO docs (idea_id, result_id, user_no, created_at_text, content, enhanced_content) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (idea.idea_id, result.result_id if result else None, user_no,
+             created_at_text, idea.content, enhanced_content)
+        ).lastrowid
+
+        for token in document_tokens(idea.content, enhanced_content):
+            self.pending.setdefault((token, user_no), []).append(doc_id)
+
+    # アイデア（と結果）をインデックスに追加・更新
+    def add(self, idea, result=None):
+        with self.connection:
+            self._add(idea, result)
+            self._flush()
+
+    # データベースの内容をインデックスに反映（新しいアイデア・新しく結果ができたアイデアだけを追加）
+    # 反映したアイデアの件数を返す
+    # 全件は読み取り専用で走査し、追加するものだけをレコードとして保持する
+    def sync(self, store):
+        result_ids = {result.idea_id: result_id for result_id, result in store.results.scan()}
+        indexed = self.indexed()
+        changed = []
+        for idea_id, idea in store.ideas.scan():
+            result_id = result_ids.get(idea_id)
+            if idea_id not in indexed or indexed[idea_id] != result_id:
+                changed.append((idea, result_id))
+
+        # 古いものから順に追加し、ドキュメントIDが作成日時の順に並ぶようにする
+        changed.sort(key=lambda item: item[0].created_at)
+        with self.connection:
+            for i, (idea, result_id) in enumerate(changed, 1):
+                self._add(idea, store.results.get(result_id) if result_id else None)
+                if i % SYNC_BATCH_SIZE == 0:
+                    self._flush()
+            self._flush()
+        return len(changed)
+
+    # トークンを含むドキュメントのID
+    def _postings(self, token, prefix, user_no):
+        if prefix:
+            condition = "token >= ? AND token < ?"
+            params = [token, token + '\U0010ffff']
+        else:
+            condition = "token = ?"
+            params = [token]
+        if user_no is not None:
+            condition += " AND user_no = ?"
+            params.append(user_no)
+        doc_ids = set()
+        for (data,) in self.connection.execute(f"SELECT doc_ids FROM postings WHERE {condition}", params):
+            doc_ids.update(unpack_doc_ids(data))
+        return doc_ids
+
+    # 検索（空白区切りの語をすべて含むアイデアを新しい順に返す）
+    # user_idを指定するとそのユーザーのアイデアだけを検索する
+    def search(self, query, user_id=None, limit=20):
+        terms = [term for term in normalize_text(query).split() if TOKEN_PATTERN.search(term)]
+        if not terms:
+            return []
+
+        user_no = None
+        if user_id is not None:
+            user_no = self.user_numbers.get(user_id)
+            if user_no is None:
+                return []
+
+        # すべてのトークンを含むドキュメントに絞り込む（件数の少ないトークンから順に）
+        candidates = None
+        tokens = {token for term in terms for token in query_tokens(term)}
+        for doc_ids in sorted((self._postings(token, prefix, user_no) for token, prefix in tokens), key=len):
+            candidates = doc_ids if candidates is None else candidates & doc_ids
+            if not candidates:
+                return []
+
+        # バイグラムが離れた位置で一致しただけのものを除き、語がそのまま含まれるものだけを新しい順に返す
+        user_ids = {number: user for user, number in self.user_numbers.items()}
+        candidates = sorted(candidates, reverse=True)
+        hits = []
+        for start in range(0, len(candidates), VERIFY_BATCH_SIZE):
+            batch = candidates[start:start + VERIFY_BATCH_SIZE]
+            rows = self.connection.execute(
+                f"SELECT idea_id, result_id, user_no, created_at_text, content, enhanced_content FROM docs "
+                f"WHERE doc_id IN ({','.join('?' * len(batch))}) ORDER BY doc_id DESC",
+                batch
+            )
+            for idea_id, result_id, hit_user_no, created_at_text, content, enhanced_content in rows:
+                texts = {
+                    FIELD_CONTENT: normalize_text(content),
+                    FIELD_ENHANCED: normalize_text(enhanced_content),
+                }
+                if not all(term in texts[FIELD_CONTENT] or term in texts[FIELD_ENHANCED] for term in terms):
+                    continue
+                matched = tuple(
+                    FIELD_NAMES[field] for field, text in texts.items()
+                    if any(term in text for term in terms)
+                )
+                snippet_field = FIELD_CONTENT if terms[0] in texts[FIELD_CONTENT] else FIELD_ENHANCED
+                hits.append(SearchHit(
+                    idea_id=idea_id,
+                    result_id=result_id,
+                    user_id=user_ids[hit_user_no],
+                    created_at=created_at_text,
+                    matched_fields=matched,
+                    snippet=make_snippet(texts[snippet_field], terms[0])
+                ))
+                if len(hits) >= limit:
+                    return hits
+        return hits
+
+def main():
+    parser = argparse.ArgumentParser(description='過去のアイデア・ブラッシュアップの全文検索')
+    parser.add_argument('query', nargs='?', help='検索語（空白区切りですべてを含むものを検索）')
+    parser.add_argument('--user', help='検索対象のユーザーID')
+    parser.add_argument('--limit', type=int, default=20, help='表示する件数')
+    parser.add_argument('--index', default=SEARCH_INDEX_PATH, help='インデックスのファイルパス')
+    parser.add_argument('--sync', metavar='DATABASE',
+                        help='データベースファイル（database.json）の内容をインデックスに反映してから検索')
+    args = parser.parse_args()
+
+    with SearchIndex(args.index) as index:
+        if args.sync:
+            with open(args.sync, 'r', encoding='utf-8') as f:
+                store = RecordStore.from_json(f.read())
+            print(f"Indexed {index.sync(store)} ideas")
+
+        if not args.query:
+            return
+
+        for hit in index.search(args.query, user_id=args.user, limit=args.limit):
+            print(f"{hit.created_at} {hit.idea_id} [{', '.join(hit.matched_fields)}] {hit.snippet}")
+
+if __name__ == "__main__":
+    main()
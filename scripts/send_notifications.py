@@ -1,19 +1,33 @@
 import os
 import json
 import base64
-import requests
 import time
-from datetime import datetime
+from records import RecordStore, read_local_store
+from line_messages import build_text_messages
+from delivery_log import (
+    DeliveryLog, MINDMAP_IMAGE_PART, delivery_unit_id, group_delivery_units, message_part_keys, retry_key_for,
+    send_packed_messages
+)
+
+# requestsは読み込みが重いため、実際に送信が必要になった時点でインポートする
 
 # 環境変数
 GITHUB_TOKEN = os.environ.get('GITHUB_TOKEN')
 GITHUB_REPO_OWNER = os.environ.get('GITHUB_REPOSITORY', '').split('/')[0]
 GITHUB_REPO_NAME = os.environ.get('GITHUB_REPOSITORY', '').split('/')[-1]
 LINE_CHANNEL_ACCESS_TOKEN = os.environ.get('LINE_CHANNEL_ACCESS_TOKEN')
-SERVER_URL = os.environ.get('SERVER_URL', 'http://localhost:3000')
+SERVER_URL = os.environ.get('SERVER_URL') or 'http://localhost:3000'  # シークレットが未設定の場合は空文字になる
+
+# マインドマップ画像の送信を試みる回数の上限（超えた場合はテキストだけで送信済みにする）
+MAX_MINDMAP_IMAGE_ATTEMPTS = int(os.environ.get('MAX_MINDMAP_IMAGE_ATTEMPTS') or 3)
 
 # マインドマップ画像を生成して送信するAPIを呼び出す関数
-def generate_and_send_mindmap(user_id, mindmap_content, result_id):
+# 戻り値は (送信に成功したか, 画像ストア上の画像ファイル名)
+# 送信に失敗しても画像はサーバーの画像ストアに残るため、ファイル名を保存しておけば再試行時に再レンダリングされない
+# retry_keyはサーバーがLINEへ送信する際の X-Line-Retry-Key として使われる
+def generate_and_send_mindmap(user_id, mindmap_content, result_id, retry_key=None):
+    import requests
+
     try:
         print(f"Calling API to generate and send mindmap for user: {user_id}")
         
@@ -23,24 +37,45 @@ def generate_and_send_mindmap(user_id, mindmap_content, result_id):
             json={
                 'userId': user_id,
                 'mindmapContent': mindmap_content,
-                'resultId': result_id
+                'resultId': result_id,
+                'retryKey': retry_key
             },
             timeout=60  # タイムアウトを60秒に設定
         )
         
+        try:
+            image_path = response.json().get('imagePath')
+        except ValueError:
+            image_path = None
+        
         if response.status_code == 200:
             print("Mindmap image generated and sent successfully")
-            return True
+            return True, image_path
         else:
             print(f"Error generating mindmap image: {response.status_code}")
             print(response.text)
-            return False
+            return False, image_path
     except Exception as e:
         print(f"Exception generating mindmap image: {e}")
+        return False, None
+
+# 生成済みのマインドマップ画像がサーバーの画像ストアに残っているかを確認する関数
+# 画像ストアは古い画像から削除されるため、送信に失敗して後日再送信する場合は削除済みのことがある
+# （確認のリクエストで最終利用時刻が更新されるため、LINEが画像を取得するまでに削除されることはない）
+def mindmap_image_available(image_url):
+    import requests
+
+    try:
+        response = requests.head(image_url, timeout=10)
+        return response.status_code == 200
+    except Exception as e:
+        print(f"Exception checking mindmap image: {e}")
         return False
 
 # GitHubからデータベースを取得
 def get_database():
+    import requests
+
     headers = {
         'Authorization': f'token {GITHUB_TOKEN}',
         'Accept': 'application/vnd.github.v3+json'
@@ -55,9 +90,9 @@ def get_database():
         
         if response.status_code == 200:
             content = base64.b64decode(response.json()['content']).decode('utf-8')
-            database = json.loads(content)
+            store = RecordStore.from_json(content)
             sha = response.json()['sha']
-            return database, sha
+            return store, sha
         else:
             print(f"Error fetching database: {response.status_code}")
             print(response.text)
@@ -68,6 +103,8 @@ def get_database():
 
 # GitHubにデータベースを更新
 def update_database(database, sha):
+    import requests
+
     headers = {
         'Authorization': f'token {GITHUB_TOKEN}',
         'Accept': 'application/vnd.github.v3+json'
@@ -101,11 +138,16 @@ def update_database(database, sha):
         return False
 
 # LINEにメッセージを送信
-def send_line_message(user_id, messages):
+# retry_keyを指定すると X-Line-Retry-Key ヘッダーを付けて送信し、同じキーの再送信はLINE側で重複が防がれる
+def send_line_message(user_id, messages, retry_key=None):
+    import requests
+
     headers = {
         'Content-Type': 'application/json',
         'Authorization': f'Bearer {LINE_CHANNEL_ACCESS_TOKEN}'
     }
+    if retry_key:
+        headers['X-Line-Retry-Key'] = retry_key
     
     data = {
         'to': user_id,
@@ -121,6 +163,10 @@ def send_line_message(user_id, messages):
         
         if response.status_code == 200:
             return True
+        elif response.status_code == 409 and retry_key:
+            # 同じリトライキーのリクエストはすでに受け付けられている
+            print(f"LINE message already accepted for retry key: {retry_key}")
+            return True
         else:
             print(f"Error sending LINE message: {response.status_code}")
             print(response.text)
@@ -129,22 +175,175 @@ def send_line_message(user_id, messages):
         print(f"Exception sending LINE message: {e}")
         return False
 
+# 結果（ダイジェストの場合は同じユーザーの複数の結果）を1つのメッセージセットとして送信
+def deliver_results(store, unit_id, results, delivery_log):
+    print(f"Sending result: {unit_id}")
+    
+    # 関連するアイデアを取得
+    entries = []
+    for result in results:
+        idea = store.ideas.get(result.idea_id)
+        
+        if not idea:
+            print(f"Idea not found for result: {result.result_id}")
+            continue
+        
+        if not idea.user_id:
+            print(f"User ID not found for idea: {idea.idea_id}")
+            continue
+        
+        entries.append((result, idea))
+    
+    if not entries:
+        return
+    
+    # ユーザーID（ダイジェストの結果はすべて同じユーザー）
+    user_id = entries[0][1].user_id
+    
+    # 先頭の結果（ダイジェストの場合、マインドマップはすべてのアイデアをまとめた1つを共有する）
+    first_result = entries[0][0]
+    mindmap_content = first_result.mindmap_content
+    
+    # LINEメッセージを作成（長文は段落・文の区切りで必要なだけ分割）
+    if len(entries) == 1:
+        result, idea = entries[0]
+        messages = build_text_messages(
+            '元のアイデア',
+            idea.content,
+            prefix="おはようございます！昨晩のアイデアを処理しました。\n\n"
+        )
+        messages.extend(build_text_messages('最終ブラッシュアップ', result.enhanced_content))
+    else:
+        # ダイジェスト：挨拶とボタンは1回だけ、アイデアごとに元のアイデアとブラッシュアップをまとめて送信
+        messages = []
+        for i, (result, idea) in enumerate(entries, 1):
+            prefix = f"おはようございます！昨晩の{len(entries)}件のアイデアをまとめて処理しました。\n\n" if i == 1 else ''
+            messages.extend(build_text_messages(
+                f'アイデア{i}/{len(entries)}',
+                f"{idea.content}\n\n【最終ブラッシュアップ】\n{result.enhanced_content}",
+                prefix=prefix
+            ))
+    
+    # 詳細を見るボタン付きメッセージを追加
+    messages.append({
+        'type': 'template',
+        'altText': '思考プロセスの詳細を見る',
+        'template': {
+            'type': 'buttons',
+            'text': '思考プロセスの詳細を見るにはボタンを押してください。',
+            'actions': [
+                {
+                    'type': 'message',
+                    'label': '詳細を見る',
+                    'text': '詳細を見る'
+                }
+            ]
+        }
+    })
+    
+    # メッセージごとのキー（配信ログで送信済みかを判定する）
+    # テキストを送信済みと記録されている場合は、配信ログが失われていても再送信しない
+    parts = list(zip(message_part_keys(messages), messages))
+    if all(result.get('text_delivered') for result, _ in entries):
+        parts = []
+    image_delivered = delivery_log.is_delivered(unit_id, MINDMAP_IMAGE_PART)
+    
+    # すでに生成されたマインドマップ画像がある場合は、同じプッシュにまとめて送信（最終ブラッシュアップ案の後に表示される）
+    # LINEの画像メッセージはHTTPSのURLしか受け付けず、1つでも不正なメッセージがあるとプッシュ全体が拒否されるため、
+    # HTTPSでない場合（SERVER_URLが未設定の場合など）は同じプッシュに含めず、APIを呼び出してサーバーから送信する
+    image_path = first_result.get('mindmap_image_path') if mindmap_content else None
+    image_url = f"{SERVER_URL}/temp/{image_path}" if image_path else None
+    if image_url and not image_url.startswith('https://'):
+        print(f"Skipping pre-generated mindmap image (not an HTTPS URL): {image_url}")
+        image_url = None
+    
+    # 画像ストアから削除されている場合も、APIを呼び出して再レンダリング・送信する
+    if image_url and not image_delivered and not mindmap_image_available(image_url):
+        print(f"Pre-generated mindmap image is no longer available: {image_path}")
+        image_url = None
+    
+    if image_url and not image_delivered:
+        print(f"Sending pre-generated mindmap image for user: {user_id}")
+        parts.append((MINDMAP_IMAGE_PART, {
+            'type': 'image',
+            'originalContentUrl': image_url,
+            'previewImageUrl': image_url
+        }))
+    
+    # LINEにメッセージを送信（送信済みのメッセージは再送信しない）
+    if not send_packed_messages(user_id, unit_id, parts, delivery_log, send_line_message):
+        print(f"Failed to send text notification to user: {user_id}")
+        return
+    
+    print(f"Successfully sent text notification to user: {user_id}")
+    image_sent = True
+    
+    if image_delivered:
+        image_generated = True
+    
+    elif image_url:
+        print(f"Successfully sent pre-generated mindmap image to user: {user_id}")
+        image_generated = True
+    
+    # マインドマップ画像を直接送信できない場合は、APIを呼び出して生成・送信
+    # （サーバーが受信時に画像を生成した結果もmindmap_image_generatedがtrueになるため、送信済みかは配信ログで判定する）
+    elif mindmap_content:
+        print(f"Generating and sending mindmap image for user: {user_id}")
+        
+        # 少し待機してからマインドマップ画像を生成して送信（LINEのレート制限対策）
+        time.sleep(1)
+        
+        # マインドマップ画像を生成して送信（最終ブラッシュアップ案とともに送信される）
+        retry_key = retry_key_for(unit_id, [MINDMAP_IMAGE_PART])
+        success, generated_image_path = generate_and_send_mindmap(user_id, mindmap_content, first_result.result_id, retry_key)
+        if generated_image_path:
+            first_result.set('mindmap_image_path', generated_image_path)
+        if success:
+            print(f"Successfully sent mindmap image to user: {user_id}")
+            delivery_log.record(unit_id, [MINDMAP_IMAGE_PART], retry_key)
+            image_generated = True
+        else:
+            # 次回の実行時は画像だけを再送信する（上限の回数に達した場合は画像をあきらめる）
+            attempts = first_result.get('mindmap_image_attempts', 0) + 1
+            first_result.set('mindmap_image_attempts', attempts)
+            if attempts >= MAX_MINDMAP_IMAGE_ATTEMPTS:
+                print(f"Giving up on mindmap image after {attempts} attempts for user: {user_id}")
+            else:
+                print(f"Failed to send mindmap image to user: {user_id} (attempt {attempts}/{MAX_MINDMAP_IMAGE_ATTEMPTS})")
+                image_sent = False
+            image_generated = False
+    
+    else:
+        image_generated = False
+    
+    for result, _ in entries:
+        if image_generated:
+            result.set('mindmap_image_generated', True)
+        
+        # すべてのメッセージを送信できた場合のみ送信済みにマーク（画像だけが残っている場合はテキストの送信を記録する）
+        result.sent = image_sent
+        if not image_sent:
+            result.set('text_delivered', True)
+
 # メイン処理
 def main():
     print("Starting notification sending...")
     
+    # チェックアウト済みのデータベースに未送信の結果がなければ、GitHubから取得せずに終了
+    local_store = read_local_store()
+    if local_store is not None and not local_store.unsent_results():
+        print("No unsent results found")
+        return
+    del local_store
+    
     # データベースを取得
-    database, sha = get_database()
-    if not database or not sha:
+    store, sha = get_database()
+    if store is None or not sha:
         print("Failed to fetch database")
         return
     
     # 未送信の結果を検索
-    unsent_results = {
-        result_id: result_data
-        for result_id, result_data in database.get('results', {}).items()
-        if not result_data.get('sent', False)
-    }
+    unsent_results = store.unsent_results()
     
     if not unsent_results:
         print("No unsent results found")
@@ -152,152 +351,19 @@ def main():
     
     print(f"Found {len(unsent_results)} unsent results")
     
-    # 各結果を処理
-    for result_id, result_data in unsent_results.items():
-        print(f"Sending result: {result_id}")
-        
-        # 関連するアイデアを取得
-        idea_id = result_data.get('idea_id', '')
-        idea_data = database.get('ideas', {}).get(idea_id, {})
-        
-        if not idea_data:
-            print(f"Idea not found for result: {result_id}")
-            continue
-        
-        # ユーザーIDを取得
-        user_id = idea_data.get('user_id', '')
-        
-        if not user_id:
-            print(f"User ID not found for idea: {idea_id}")
-            continue
-        
-        # 元のアイデア内容
-        original_idea = idea_data.get('content', '')
-        
-        # ブラッシュアップされた内容
-        enhanced_content = result_data.get('enhanced_content', '')
-        
-        # マインドマップ
-        mindmap_content = result_data.get('mindmap_content', '')
-        
-        # 最大メッセージ長（LINEの制限は5000文字だが、余裕を持たせる）
-        max_length = 4000
-        
-        # LINEメッセージを作成
-        messages = [
-            {
-                'type': 'text',
-                'text': f"おはようございます！昨晩のアイデアを処理しました。\n\n【元のアイデア】\n{original_idea}"
-            }
-        ]
-        
-        # ブラッシュアップ（長文の場合は分割）
-        if len(enhanced_content) <= max_length:
-            # 通常のケース：1つのメッセージで送信
-            messages.append({
-                'type': 'text',
-                'text': f"【最終ブラッシュアップ】\n{enhanced_content}"
-            })
-        else:
-            # 長文の場合：分割して送信
-            part1 = enhanced_content[:max_length]
-            part2 = enhanced_content[max_length:]
-            
-            messages.append({
-                'type': 'text',
-                'text': f"【最終ブラッシュアップ (1/2)】\n{part1}"
-            })
-            
-            messages.append({
-                'type': 'text',
-                'text': f"【最終ブラッシュアップ (2/2)】\n{part2}"
-            })
-        
-        # 詳細を見るボタン付きメッセージを追加
-        messages.append({
-            'type': 'template',
-            'altText': '思考プロセスの詳細を見る',
-            'template': {
-                'type': 'buttons',
-                'text': '思考プロセスの詳細を見るにはボタンを押してください。',
-                'actions': [
-                    {
-                        'type': 'message',
-                        'label': '詳細を見る',
-                        'text': '詳細を見る'
-                    }
-                ]
-            }
-        })
-        
-        # LINEにメッセージを送信
-        if send_line_message(user_id, messages):
-            print(f"Successfully sent text notification to user: {user_id}")
-            
-            # マインドマップ画像を送信（最終ブラッシュアップ案の後に送信される）
-            if mindmap_content:
-                # すでに生成されたマインドマップ画像がある場合
-                if result_data.get('mindmap_image_path'):
-                    print(f"Sending pre-generated mindmap image for user: {user_id}")
-                    
-                    # 少し待機してからマインドマップ画像を送信（LINEのレート制限対策）
-                    time.sleep(1)
-                    
-                    # 画像のURLを生成
-                    image_path = result_data.get('mindmap_image_path')
-                    image_url = f"{SERVER_URL}/temp/{image_path}"
-                    
-                    # LINEに画像を送信
-                    try:
-                        response = requests.post(
-                            'https://api.line.me/v2/bot/message/push',
-                            json={
-                                'to': user_id,
-                                'messages': [
-                                    {
-                                        'type': 'image',
-                                        'originalContentUrl': image_url,
-                                        'previewImageUrl': image_url
-                                    }
-                                ]
-                            },
-                            headers={
-                                'Content-Type': 'application/json',
-                                'Authorization': f'Bearer {LINE_CHANNEL_ACCESS_TOKEN}'
-                            }
-                        )
-                        
-                        if response.status_code == 200:
-                            print(f"Successfully sent pre-generated mindmap image to user: {user_id}")
-                            database['results'][result_id]['mindmap_image_generated'] = True
-                        else:
-                            print(f"Failed to send pre-generated mindmap image to user: {user_id}")
-                            print(f"Error: {response.status_code} - {response.text}")
-                    except Exception as e:
-                        print(f"Exception sending pre-generated mindmap image: {e}")
-                
-                # マインドマップ画像がない場合は、APIを呼び出して生成・送信
-                elif not result_data.get('mindmap_image_generated', False):
-                    print(f"Generating and sending mindmap image for user: {user_id}")
-                    
-                    # 少し待機してからマインドマップ画像を生成して送信（LINEのレート制限対策）
-                    time.sleep(1)
-                    
-                    # マインドマップ画像を生成して送信（最終ブラッシュアップ案とともに送信される）
-                    if generate_and_send_mindmap(user_id, mindmap_content, result_id):
-                        print(f"Successfully sent mindmap image to user: {user_id}")
-                        database['results'][result_id]['mindmap_image_generated'] = True
-                    else:
-                        print(f"Failed to send mindmap image to user: {user_id}")
-            
-            # 送信済みにマーク
-            database['results'][result_id]['sent'] = True
-        else:
-            print(f"Failed to send text notification to user: {user_id}")
+    # 配信ログを読み込む（前回の実行で送信済みのメッセージは再送信しない）
+    delivery_log = DeliveryLog()
+    
+    # 各結果を処理（ダイジェストモードで処理された結果はまとめて送信）
+    for unit_id, results in group_delivery_units(unsent_results):
+        deliver_results(store, unit_id, results, delivery_log)
     
     # データベースを更新
-    if update_database(database, sha):
+    if update_database(store.to_dict(), sha):
         print("Database updated successfully")
+        
+        # 送信済みとして保存された結果の配信ログは不要になるため削除
+        delivery_log.compact(delivery_unit_id(result) for result in store.unsent_results())
     else:
         print("Failed to update database")
 
@@ -1,22 +1,32 @@
 import os
 import json
-import requests
-from datetime import datetime
-from dotenv import load_dotenv
+from records import RecordStore
+from line_messages import build_text_messages
+from delivery_log import (
+    DeliveryLog, delivery_unit_id, group_delivery_units, message_part_keys, send_packed_messages
+)
 
-# .envファイルから環境変数を読み込む
-load_dotenv()
+# requests・dotenvは読み込みが重いため、実際に送信が必要になった時点でインポートする
 
-# 環境変数
-LINE_CHANNEL_ACCESS_TOKEN = os.environ.get('LINE_CHANNEL_ACCESS_TOKEN')
+# LINEチャネルアクセストークンを遅延読み込み
+_line_channel_access_token = None
 
-print(f"Using LINE Channel Access Token: {LINE_CHANNEL_ACCESS_TOKEN[:5]}...{LINE_CHANNEL_ACCESS_TOKEN[-5:]}")
+def get_line_channel_access_token():
+    global _line_channel_access_token
+    if _line_channel_access_token is None:
+        from dotenv import load_dotenv
+
+        # .envファイルから環境変数を読み込む
+        load_dotenv()
+        _line_channel_access_token = os.environ.get('LINE_CHANNEL_ACCESS_TOKEN', '')
+        print(f"Using LINE Channel Access Token: {_line_channel_access_token[:5]}...{_line_channel_access_token[-5:]}")
+    return _line_channel_access_token
 
 # ローカルデータベースを読み込む
 def read_database():
     try:
         with open('data/database.json', 'r', encoding='utf-8') as f:
-            return json.load(f)
+            return RecordStore.from_json(f.read())
     except Exception as e:
         print(f"Error reading database: {e}")
         return None
@@ -32,11 +42,16 @@ def save_database(database):
         return False
 
 # LINEにメッセージを送信
-def send_line_message(user_id, messages):
+# retry_keyを指定すると X-Line-Retry-Key ヘッダーを付けて送信し、同じキーの再送信はLINE側で重複が防がれる
+def send_line_message(user_id, messages, retry_key=None):
+    import requests
+
     headers = {
         'Content-Type': 'application/json',
-        'Authorization': f'Bearer {LINE_CHANNEL_ACCESS_TOKEN}'
+        'Authorization': f'Bearer {get_line_channel_access_token()}'
     }
+    if retry_key:
+        headers['X-Line-Retry-Key'] = retry_key
     
     data = {
         'to': user_id,
@@ -52,6 +67,10 @@ def send_line_message(user_id, messages):
         
         if response.status_code == 200:
             return True
+        elif response.status_code == 409 and retry_key:
+            # 同じリトライキーのリクエストはすでに受け付けられている
+            print(f"LINE message already accepted for retry key: {retry_key}")
+            return True
         else:
             print(f"Error sending LINE message: {response.status_code}")
             print(response.text)
@@ -65,17 +84,13 @@ def main():
     print("Starting notification sending...")
     
     # データベースを取得
-    database = read_database()
-    if not database:
+    store = read_database()
+    if store is None:
         print("Failed to read database")
         return
     
     # 未送信の結果を検索
-    unsent_results = {
-        result_id: result_data
-        for result_id, result_data in database.get('results', {}).items()
-        if not result_data.get('sent', False)
-    }
+    unsent_results = store.unsent_results()
     
     if not unsent_results:
         print("No unsent results found")
@@ -83,62 +98,75 @@ def main():
     
     print(f"Found {len(unsent_results)} unsent results")
     
-    # 各結果を処理
-    for result_id, result_data in unsent_results.items():
-        print(f"Sending result: {result_id}")
+    # 配信ログを読み込む（前回の実行で送信済みのメッセージは再送信しない）
+    delivery_log = DeliveryLog()
+    
+    # 送信の単位（ダイジェストモードで処理された結果は同じダイジェストIDごと）に処理
+    for unit_id, results in group_delivery_units(unsent_results):
+        print(f"Sending result: {unit_id}")
         
         # 関連するアイデアを取得
-        idea_id = result_data.get('idea_id', '')
-        idea_data = database.get('ideas', {}).get(idea_id, {})
-        
-        if not idea_data:
-            print(f"Idea not found for result: {result_id}")
-            continue
-        
-        # ユーザーIDを取得
-        user_id = idea_data.get('user_id', '')
+        entries = []
+        for result in results:
+            idea = store.ideas.get(result.idea_id)
+            
+            if not idea:
+                print(f"Idea not found for result: {result.result_id}")
+                continue
+            
+            if not idea.user_id:
+                print(f"User ID not found for idea: {idea.idea_id}")
+                continue
+            
+            entries.append((result, idea))
         
-        if not user_id:
-            print(f"User ID not found for idea: {idea_id}")
+        if not entries:
             continue
         
-        # 元のアイデア内容
-        original_idea = idea_data.get('content', '')
+        # ユーザーID（ダイジェストの結果はすべて同じユーザー）
+        user_id = entries[0][1].user_id
         
-        # ブラッシュアップされた内容
-        enhanced_content = result_data.get('enhanced_content', '')
+        # マインドマップ（ダイジェストの場合はすべてのアイデアをまとめた1つを共有する）
+        mindmap_content = entries[0][0].mindmap_content
         
-        # マインドマップ
-        mindmap_content = result_data.get('mindmap_content', '')
-        
-        # LINEメッセージを作成
-        messages = [
-            {
-                'type': 'text',
-                'text': f"おはようございます！昨晩のアイデアを処理しました。\n\n【元のアイデア】\n{original_idea}"
-            },
-            {
-                'type': 'text',
-                'text': f"【ブラッシュアップ】\n{enhanced_content}"
-            },
-            {
-                'type': 'text',
-                'text': f"【マインドマップ】\n{mindmap_content}"
-            }
-        ]
+        # LINEメッセージを作成（長文は段落・文の区切りで必要なだけ分割）
+        if len(entries) == 1:
+            result, idea = entries[0]
+            messages = build_text_messages(
+                '元のアイデア',
+                idea.content,
+                prefix="おはようございます！昨晩のアイデアを処理しました。\n\n"
+            )
+            messages.extend(build_text_messages('ブラッシュアップ', result.enhanced_content))
+        else:
+            # ダイジェスト：挨拶とマインドマップは1回だけ、アイデアごとに元のアイデアとブラッシュアップをまとめて送信
+            messages = []
+            for i, (result, idea) in enumerate(entries, 1):
+                prefix = f"おはようございます！昨晩の{len(entries)}件のアイデアをまとめて処理しました。\n\n" if i == 1 else ''
+                messages.extend(build_text_messages(
+                    f'アイデア{i}/{len(entries)}',
+                    f"{idea.content}\n\n【ブラッシュアップ】\n{result.enhanced_content}",
+                    prefix=prefix
+                ))
+        messages.extend(build_text_messages('マインドマップ', mindmap_content))
         
-        # LINEにメッセージを送信
-        if send_line_message(user_id, messages):
+        # LINEにメッセージを送信（送信済みのメッセージは再送信しない）
+        parts = list(zip(message_part_keys(messages), messages))
+        if send_packed_messages(user_id, unit_id, parts, delivery_log, send_line_message):
             print(f"Successfully sent notification to user: {user_id}")
             
             # 送信済みにマーク
-            database['results'][result_id]['sent'] = True
+            for result, _ in entries:
+                result.sent = True
         else:
             print(f"Failed to send notification to user: {user_id}")
     
     # データベースを更新
-    if save_database(database):
+    if save_database(store.to_dict()):
         print("Database updated successfully")
+        
+        # 送信済みとして保存された結果の配信ログは不要になるため削除
+        delivery_log.compact(delivery_unit_id(result) for result in store.unsent_results())
     else:
         print("Failed to update database")
 
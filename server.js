@@ -44,6 +44,16 @@ app.use(bodyParser.json({
 }));
 
 // 一時ファイル用のディレクトリを静的ファイルとして配信
+// マインドマップ画像は配信（送信前の確認・LINEからの取得）のたびに最終利用時刻を更新し、画像ストアから削除されないようにする
+app.use('/temp', (req, res, next) => {
+  const name = path.basename(req.path);
+  if (MINDMAP_IMAGE_PATTERN.test(name)) {
+    const now = new Date();
+    fs.utimes(path.join(__dirname, 'temp', name), now, now, () => next());
+    return;
+  }
+  next();
+});
 app.use('/temp', express.static(path.join(__dirname, 'temp')));
 
 // LINEメッセージ送信関数
@@ -291,6 +301,42 @@ function convertTextMindmapToMermaid(textMindmap) {
   return mermaidCode;
 }
 
+// マインドマップ画像のレンダリング設定
+// スマートフォン表示に最適化したサイズ比
+// 縦長の比率（9:16）に近い値を設定
+// 幅を小さく、高さを大きくする
+// theme: テーマ (forest - より見やすいテーマ)
+// background: 背景色 (white - 透明背景ではなく白背景)
+// width / height: 幅と高さ
+// scale: スケール (2 - 文字を大きく)
+const MINDMAP_RENDER_SETTINGS = {
+  theme: 'forest',
+  background: 'white',
+  width: 800,
+  height: 1200,
+  scale: 2
+};
+
+// 日本語フォント対応のカスタムCSS
+const MINDMAP_CSS = `
+        /* 日本語フォント対応 */
+        .node rect, .node circle, .node ellipse, .node polygon, .node path {
+          fill: #fff;
+          stroke: #1f2020;
+          stroke-width: 1px;
+        }
+        .node .label {
+          font-family: 'Noto Sans JP', 'Meiryo', 'Yu Gothic', 'Hiragino Sans', sans-serif;
+        }
+        .node text {
+          font-family: 'Noto Sans JP', 'Meiryo', 'Yu Gothic', 'Hiragino Sans', sans-serif;
+          font-size: 14px;
+        }
+        .edgeLabel {
+          font-family: 'Noto Sans JP', 'Meiryo', 'Yu Gothic', 'Hiragino Sans', sans-serif;
+        }
+      `;
+
 // Mermaid形式から画像を生成する関数
 async function generateMindmapImage(mermaidCode) {
   // 一時ディレクトリの作成（存在しない場合）
@@ -300,14 +346,14 @@ async function generateMindmapImage(mermaidCode) {
   }
   
   // 一時ファイルパスの生成
-  const timestamp = Date.now();
+  const timestamp = `${Date.now()}_${crypto.randomBytes(4).toString('hex')}`;
   const tempMmdFile = path.join(tempDir, `mindmap_${timestamp}.mmd`);
   const outputSvgFile = path.join(tempDir, `mindmap_${timestamp}.svg`);
   
   // Mermaidコードを一時ファイルに書き込む
   fs.writeFileSync(tempMmdFile, mermaidCode);
   
-  // mmdc CLIを使用してPNG画像を生成
+  // mmdc CLIを使用してSVG画像を生成
   return new Promise((resolve, reject) => {
     // Puppeteerに--no-sandboxオプションを追加（Railwayなどのクラウド環境用）
     // 一時的な設定ファイルを作成
@@ -319,40 +365,12 @@ async function generateMindmapImage(mermaidCode) {
     try {
       fs.writeFileSync(puppeteerConfigPath, JSON.stringify(puppeteerConfig));
       
-      // 見やすさを改善するためのオプション
-      // -t: テーマ (forest - より見やすいテーマ)
-      // -b: 背景色 (white - 透明背景ではなく白背景)
-      // -w: 幅 (1200px - 横長の問題を解決)
-      // -H: 高さ (800px - 適切な高さ)
-      // -s: スケール (2 - 文字を大きく)
-      // -C: カスタムCSS (日本語フォントを指定)
-      
       // 一時的なCSSファイルを作成（日本語フォント対応）
-      const cssContent = `
-        /* 日本語フォント対応 */
-        .node rect, .node circle, .node ellipse, .node polygon, .node path {
-          fill: #fff;
-          stroke: #1f2020;
-          stroke-width: 1px;
-        }
-        .node .label {
-          font-family: 'Noto Sans JP', 'Meiryo', 'Yu Gothic', 'Hiragino Sans', sans-serif;
-        }
-        .node text {
-          font-family: 'Noto Sans JP', 'Meiryo', 'Yu Gothic', 'Hiragino Sans', sans-serif;
-          font-size: 14px;
-        }
-        .edgeLabel {
-          font-family: 'Noto Sans JP', 'Meiryo', 'Yu Gothic', 'Hiragino Sans', sans-serif;
-        }
-      `;
       const cssFilePath = path.join(tempDir, `custom_style_${timestamp}.css`);
-      fs.writeFileSync(cssFilePath, cssContent);
+      fs.writeFileSync(cssFilePath, MINDMAP_CSS);
       
-      // スマートフォン表示に最適化したサイズ比
-      // 縦長の比率（9:16）に近い値を設定
-      // 幅を小さく、高さを大きくする
-      exec(`npx mmdc -i ${tempMmdFile} -o ${outputSvgFile} -t forest -b white -w 800 -H 1200 -s 2 -p ${puppeteerConfigPath} -C ${cssFilePath}`, (error, stdout, stderr) => {
+      const { theme, background, width, height, scale } = MINDMAP_RENDER_SETTINGS;
+      exec(`npx mmdc -i ${tempMmdFile} -o ${outputSvgFile} -t ${theme} -b ${background} -w ${width} -H ${height} -s ${scale} -p ${puppeteerConfigPath} -C ${cssFilePath}`, (error, stdout, stderr) => {
         // 一時ファイルを削除
         try {
           fs.unlinkSync(tempMmdFile);
@@ -377,8 +395,113 @@ async function generateMindmapImage(mermaidCode) {
   });
 }
 
+// マインドマップ画像ストアの設定
+// 画像は正規化したマインドマップテキストとレンダリング設定のハッシュをファイル名として保存し、
+// 同じ内容のマインドマップは再レンダリングせずに使い回す
+const MINDMAP_CACHE_MAX_BYTES = parseInt(process.env.MINDMAP_CACHE_MAX_BYTES || `${100 * 1024 * 1024}`, 10); // 合計サイズの上限
+const MINDMAP_CACHE_MAX_ENTRIES = parseInt(process.env.MINDMAP_CACHE_MAX_ENTRIES || '500', 10); // 画像数の上限
+const MINDMAP_CACHE_MIN_AGE_MS = 24 * 60 * 60 * 1000; // 翌朝の送信で参照されるため、最後の利用から24時間は削除しない
+const MINDMAP_IMAGE_PATTERN = /^mindmap_[0-9a-f]{64}\.svg$/;
+
+// 同じ画像を同時にレンダリングしないよう、処理中のレンダリングを保持する
+const pendingMindmapRenders = new Map();
+
+// マインドマップテキストを正規化する関数（改行コード・コードブロック・行末の空白・空行の違いを無視）
+function normalizeMindmapText(textMindmap) {
+  return textMindmap
+    .replace(/\r\n?/g, '\n')
+    .replace(/```/g, '')
+    .split('\n')
+    .map(line => line.replace(/\s+$/, ''))
+    .filter(line => line.trim())
+    .join('\n');
+}
+
+// マインドマップ画像のキー（正規化したテキストとレンダリング設定のハッシュ）を計算する関数
+function getMindmapImageKey(textMindmap) {
+  return crypto
+    .createHash('sha256')
+    .update(JSON.stringify({
+      mindmap: normalizeMindmapText(textMindmap),
+      settings: MINDMAP_RENDER_SETTINGS,
+      css: MINDMAP_CSS
+    }))
+    .digest('hex');
+}
+
+// 古い画像を削除してストアを上限内に収める関数（最後に使われた時刻が古いものから削除）
+function evictMindmapImages() {
+  const tempDir = path.join(__dirname, 'temp');
+  try {
+    const entries = fs.readdirSync(tempDir)
+      .filter(name => MINDMAP_IMAGE_PATTERN.test(name))
+      .map(name => {
+        const filePath = path.join(tempDir, name);
+        const stat = fs.statSync(filePath);
+        return { filePath, size: stat.size, lastUsed: stat.mtimeMs };
+      })
+      .sort((a, b) => a.lastUsed - b.lastUsed);
+    
+    let totalBytes = entries.reduce((sum, entry) => sum + entry.size, 0);
+    let count = entries.length;
+    const now = Date.now();
+    
+    for (const entry of entries) {
+      if (totalBytes <= MINDMAP_CACHE_MAX_BYTES && count <= MINDMAP_CACHE_MAX_ENTRIES) break;
+      if (now - entry.lastUsed < MINDMAP_CACHE_MIN_AGE_MS) break;
+      
+      fs.unlinkSync(entry.filePath);
+      totalBytes -= entry.size;
+      count -= 1;
+      console.log(`Evicted mindmap image: ${path.basename(entry.filePath)}`);
+    }
+  } catch (err) {
+    console.error(`Error evicting mindmap images: ${err.message}`);
+  }
+}
+
+// マインドマップ画像をストアから取得し、なければ生成する関数
+async function getOrRenderMindmapImage(textMindmap) {
+  const key = getMindmapImageKey(textMindmap);
+  const imagePath = path.join(__dirname, 'temp', `mindmap_${key}.svg`);
+  
+  // 生成済みの場合は最終利用時刻を更新して返す
+  if (fs.existsSync(imagePath)) {
+    const now = new Date();
+    fs.utimesSync(imagePath, now, now);
+    console.log(`Mindmap image cache hit: ${path.basename(imagePath)}`);
+    return imagePath;
+  }
+  
+  // 同じ画像をレンダリング中の場合は、その結果を待つ
+  if (pendingMindmapRenders.has(key)) {
+    return pendingMindmapRenders.get(key);
+  }
+  
+  const render = (async () => {
+    try {
+      // テキストマインドマップをMermaid形式に変換
+      // （キーと同じ正規化済みテキストから生成し、同じキーの画像が常に同じ内容になるようにする）
+      const mermaidCode = convertTextMindmapToMermaid(normalizeMindmapText(textMindmap));
+      
+      // 一時ファイルに生成してから名前を変更（生成途中のファイルを配信しないため）
+      const renderedPath = await generateMindmapImage(mermaidCode);
+      fs.renameSync(renderedPath, imagePath);
+      
+      evictMindmapImages();
+      return imagePath;
+    } finally {
+      pendingMindmapRenders.delete(key);
+    }
+  })();
+  
+  pendingMindmapRenders.set(key, render);
+  return render;
+}
+
 // マインドマップ画像をLINEに送信する関数
-async function sendMindmapImageToLine(userId, imagePath) {
+// retryKeyを指定すると X-Line-Retry-Key ヘッダーを付けて送信し、同じキーの再送信はLINE側で重複が防がれる
+async function sendMindmapImageToLine(userId, imagePath, retryKey = null) {
   try {
     // 画像のURLを生成
     // 注: SERVER_URLがhttpsで始まることを確認（LINEの要件）
@@ -401,6 +524,14 @@ async function sendMindmapImageToLine(userId, imagePath) {
     console.log(`Sending image with URL: ${imageUrl}`);
     
     // LINEに画像を送信
+    const headers = {
+      'Content-Type': 'application/json',
+      'Authorization': `Bearer ${LINE_CHANNEL_ACCESS_TOKEN}`
+    };
+    if (retryKey) {
+      headers['X-Line-Retry-Key'] = retryKey;
+    }
+    
     await axios.post('https://api.line.me/v2/bot/message/push', {
       to: userId,
       messages: [
@@ -411,15 +542,18 @@ async function sendMindmapImageToLine(userId, imagePath) {
         }
       ]
     }, {
-      headers: {
-        'Content-Type': 'application/json',
-        'Authorization': `Bearer ${LINE_CHANNEL_ACCESS_TOKEN}`
-      }
+      headers: headers
     });
     
     console.log('Mindmap image sent successfully');
     return true;
   } catch (error) {
+    // 同じリトライキーのリクエストはすでに受け付けられている
+    if (retryKey && error.response && error.response.status === 409) {
+      console.log(`Mindmap image already accepted for retry key: ${retryKey}`);
+      return true;
+    }
+    
     console.error('Error sending mindmap image:', error);
     if (error.response) {
       console.error('Response data:', error.response.data);
@@ -502,27 +636,13 @@ ${enhancedResult.finalEnhancement}`
 // マインドマップを生成して画像として送信する関数
 async function generateAndSendMindmapImage(userId, textMindmap) {
   try {
-    // テキストマインドマップをMermaid形式に変換
-    const mermaidCode = convertTextMindmapToMermaid(textMindmap);
-    
-    // Mermaid形式から画像を生成
-    const imagePath = await generateMindmapImage(mermaidCode);
+    // マインドマップ画像をストアから取得（なければ生成）
+    // 画像はストアの上限に応じて古いものから削除される
+    const imagePath = await getOrRenderMindmapImage(textMindmap);
     
     // 画像をLINEに送信
     await sendMindmapImageToLine(userId, imagePath);
     
-    // 一定時間後に一時ファイルを削除
-    setTimeout(() => {
-      try {
-        if (fs.existsSync(imagePath)) {
-          fs.unlinkSync(imagePath);
-          console.log(`Temporary file ${imagePath} deleted`);
-        }
-      } catch (err) {
-        console.error(`Error deleting temporary file: ${err.message}`);
-      }
-    }, 3600000); // 1時間後に削除
-    
     return true;
   } catch (error) {
     console.error('Error in mindmap image generation and sending:', error);
@@ -818,11 +938,8 @@ app.post('/webhook', async (req, res) => {
           // マインドマップ画像を生成（送信はしない）
           console.log('Generating mindmap image...');
           try {
-            // テキストマインドマップをMermaid形式に変換
-            const mermaidCode = convertTextMindmapToMermaid(mindmapContent);
-            
-            // Mermaid形式から画像を生成
-            const imagePath = await generateMindmapImage(mermaidCode);
+            // マインドマップ画像をストアから取得（なければ生成）
+            const imagePath = await getOrRenderMindmapImage(mindmapContent);
             
             // 画像のURLを生成
             const imageUrl = `${SERVER_URL}/temp/${path.basename(imagePath)}`;
@@ -897,7 +1014,7 @@ app.get('/', (req, res) => {
 app.post('/api/generate-mindmap', async (req, res) => {
   try {
     // リクエストボディの検証
-    const { userId, mindmapContent, resultId } = req.body;
+    const { userId, mindmapContent, resultId, retryKey } = req.body;
     
     if (!userId || !mindmapContent || !resultId) {
       return res.status(400).json({ error: 'Missing required parameters' });
@@ -907,20 +1024,20 @@ app.post('/api/generate-mindmap', async (req, res) => {
     console.log(`Generating and sending mindmap image for user: ${userId}`);
     
     try {
-      // テキストマインドマップをMermaid形式に変換
-      const mermaidCode = convertTextMindmapToMermaid(mindmapContent);
-      
-      // Mermaid形式から画像を生成
-      const imagePath = await generateMindmapImage(mermaidCode);
+      // マインドマップ画像をストアから取得（なければ生成）
+      // 送信に失敗しても画像はストアに残るため、再試行時は再レンダリングされない
+      const imagePath = await getOrRenderMindmapImage(mindmapContent);
+      const imageName = path.basename(imagePath);
       
       // 画像をLINEに送信
-      const success = await sendMindmapImageToLine(userId, imagePath);
+      const success = await sendMindmapImageToLine(userId, imagePath, retryKey);
       
       if (success) {
         // データベースを更新（マインドマップ画像生成フラグをtrueに設定）
         const database = readDatabase();
         if (database.results[resultId]) {
           database.results[resultId].mindmap_image_generated = true;
+          database.results[resultId].mindmap_image_path = imageName;
           saveDatabase(database);
           
           // GitHubにも更新を反映
@@ -946,9 +1063,9 @@ app.post('/api/generate-mindmap', async (req, res) => {
           }
         }
         
-        return res.status(200).json({ success: true, message: 'Mindmap image generated and sent successfully' });
+        return res.status(200).json({ success: true, message: 'Mindmap image generated and sent successfully', imagePath: imageName });
       } else {
-        return res.status(500).json({ error: 'Failed to send mindmap image' });
+        return res.status(500).json({ error: 'Failed to send mindmap image', imagePath: imageName });
       }
     } catch (error) {
       console.error('Error in mindmap image generation and sending:', error);
@@ -0,0 +1,242 @@
+import os
+import sys
+import json
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'scripts'))
+
+import send_notifications
+from delivery_log import (
+    MINDMAP_IMAGE_PART,
+    DeliveryLog,
+    message_part_keys,
+    retry_key_for,
+    send_packed_messages,
+)
+from line_messages import MAX_MESSAGES_PER_REQUEST
+from records import RecordStore
+
+# 配信ログと再送信のテスト
+# 途中で失敗・中断した場合も、再実行時は未送信のメッセージだけが送信され、重複しないことを確認する
+
+def text_parts(count):
+    messages = [{'type': 'text', 'text': f"メッセージ{i}"} for i in range(count)]
+    return list(zip(message_part_keys(messages), messages))
+
+# 送信したプッシュを記録する送信関数（failは失敗させるプッシュの番号）
+class Sender:
+    def __init__(self, fail=()):
+        self.fail = set(fail)
+        self.calls = 0
+        self.pushes = []
+
+    def __call__(self, user_id, messages, retry_key=None):
+        self.calls += 1
+        if self.calls in self.fail:
+            return False
+        self.pushes.append((user_id, [message.get('text') for message in messages], retry_key))
+        return True
+
+def test_message_part_keys_number_duplicates():
+    messages = [{'type': 'text', 'text': 'a'}, {'type': 'text', 'text': 'a'}, {'type': 'text', 'text': 'b'}]
+    keys = message_part_keys(messages)
+    assert len(set(keys)) == 3
+    assert keys[1] == f"{keys[0]}:2"
+    assert message_part_keys(messages) == keys
+
+def test_send_packed_messages_records_each_push(tmp_path):
+    log = DeliveryLog(str(tmp_path / 'delivery_log.jsonl'))
+    parts = text_parts(12)
+    sender = Sender()
+
+    assert send_packed_messages('U1', 'result_1', parts, log, sender)
+
+    assert [len(texts) for _, texts, _ in sender.pushes] == [5, 5, 2]
+    for i, (_, _, retry_key) in enumerate(sender.pushes):
+        batch = parts[i * MAX_MESSAGES_PER_REQUEST:(i + 1) * MAX_MESSAGES_PER_REQUEST]
+        assert retry_key == retry_key_for('result_1', [key for key, _ in batch])
+    assert all(log.is_delivered('result_1', key) for key, _ in parts)
+
+    # 記録はファイルに保存され、読み込み直しても送信済みになる
+    reloaded = DeliveryLog(log.path)
+    assert all(reloaded.is_delivered('result_1', key) for key, _ in parts)
+    assert not reloaded.is_delivered('result_2', parts[0][0])
+
+def test_crash_mid_run_resends_only_missing_messages(tmp_path):
+    path = str(tmp_path / 'delivery_log.jsonl')
+    parts = text_parts(12)
+
+    # 2回目のプッシュで失敗
+    failing = Sender(fail={2})
+    assert not send_packed_messages('U1', 'result_1', parts, DeliveryLog(path), failing)
+    assert len(failing.pushes) == 1
+
+    # 再実行では未送信の7件だけを、同じ組み合わせなら同じリトライキーで送信する
+    sender = Sender()
+    assert send_packed_messages('U1', 'result_1', parts, DeliveryLog(path), sender)
+    sent = [text for _, texts, _ in failing.pushes + sender.pushes for text in texts]
+    assert sent == [message['text'] for _, message in parts]
+    assert sender.pushes[0][2] == retry_key_for('result_1', [key for key, _ in parts[5:10]])
+
+    # すべて送信済みの場合は何も送信しない
+    again = Sender()
+    assert send_packed_messages('U1', 'result_1', parts, DeliveryLog(path), again)
+    assert again.calls == 0
+
+def test_interrupted_write_is_ignored(tmp_path):
+    path = tmp_path / 'delivery_log.jsonl'
+    log = DeliveryLog(str(path))
+    log.record('result_1', ['text:a'], 'key')
+    with open(path, 'a', encoding='utf-8') as f:
+        f.write('{"result_id": "result_1", "part": "te')
+
+    reloaded = DeliveryLog(str(path))
+    assert reloaded.is_delivered('result_1', 'text:a')
+    assert len(reloaded.entries) == 1
+
+def test_compact_keeps_only_given_results(tmp_path):
+    path = tmp_path / 'delivery_log.jsonl'
+    log = DeliveryLog(str(path))
+    log.record('result_1', ['text:a', 'text:b'], 'key1')
+    log.record('result_2', ['text:c'], 'key2')
+
+    log.compact(['result_2', 'result_3'])
+
+    assert not log.is_delivered('result_1', 'text:a')
+    assert log.is_delivered('result_2', 'text:c')
+    with open(path, 'r', encoding='utf-8') as f:
+        assert [json.loads(line)['result_id'] for line in f] == ['result_2']
+    assert DeliveryLog(str(path)).delivered == {('result_2', 'text:c')}
+
+    log.compact([])
+    assert path.read_text(encoding='utf-8') == ''
+    assert not os.path.exists(f"{path}.tmp")
+
+# deliver_resultsの再送信
+IDEA = {'user_id': 'U1', 'content': 'アイデア', 'created_at': '2025-04-06T11:54:05.972Z', 'processed': True}
+RESULT = {
+    'idea_id': 'idea_1',
+    'enhanced_content': 'ブラッシュアップ',
+    'mindmap_content': '* 中心\n  - 枝',
+    'created_at': '2025-04-06T21:15:15.098764',
+    'sent': False,
+}
+
+# 毎朝の実行をまねて、データベース（dict）を読み込み、未送信の結果を送信して保存する
+def run_morning(database, log_path, sender, render):
+    store = RecordStore.from_dict(database)
+    delivery_log = DeliveryLog(log_path)
+    send_notifications.send_line_message = sender
+    send_notifications.generate_and_send_mindmap = render
+    for unit_id, results in send_notifications.group_delivery_units(store.unsent_results()):
+        send_notifications.deliver_results(store, unit_id, results, delivery_log)
+    return store.to_dict()
+
+class Renderer:
+    def __init__(self, succeed):
+        self.succeed = succeed
+        self.calls = []
+
+    def __call__(self, user_id, mindmap_content, result_id, retry_key=None):
+        self.calls.append(retry_key)
+        return self.succeed(len(self.calls)), 'mindmap_abc.svg'
+
+@pytest.fixture
+def morning(monkeypatch, tmp_path):
+    monkeypatch.setattr(send_notifications, 'send_line_message', None)
+    monkeypatch.setattr(send_notifications, 'generate_and_send_mindmap', None)
+    monkeypatch.setattr(send_notifications.time, 'sleep', lambda seconds: None)
+    monkeypatch.setattr(send_notifications, 'MAX_MINDMAP_IMAGE_ATTEMPTS', 3)
+    database = {'users': {}, 'ideas': {'idea_1': IDEA}, 'results': {'result_1': RESULT}}
+    return database, str(tmp_path / 'delivery_log.jsonl')
+
+def test_failed_image_is_retried_without_resending_text(morning):
+    database, log_path = morning
+    sender = Sender()
+    renderer = Renderer(lambda attempt: attempt == 2)
+
+    database = run_morning(database, log_path, sender, renderer)
+    result = database['results']['result_1']
+    assert result['sent'] is False
+    assert result['text_delivered'] is True
+    assert result['mindmap_image_attempts'] == 1
+    assert len(sender.pushes) == 1
+
+    # 翌朝は画像だけを同じリトライキーで再送信する
+    database = run_morning(database, log_path, sender, renderer)
+    result = database['results']['result_1']
+    assert result['sent'] is True
+    assert result['mindmap_image_generated'] is True
+    assert len(sender.pushes) == 1
+    assert renderer.calls == [retry_key_for('result_1', [MINDMAP_IMAGE_PART])] * 2
+
+def test_image_is_given_up_after_max_attempts(morning):
+    database, log_path = morning
+    sender = Sender()
+    renderer = Renderer(lambda attempt: False)
+
+    for attempt in range(1, 4):
+        database = run_morning(database, log_path, sender, renderer)
+        assert database['results']['result_1']['mindmap_image_attempts'] == attempt
+    result = database['results']['result_1']
+    assert result['sent'] is True
+    assert 'mindmap_image_generated' not in result
+    assert len(sender.pushes) == 1
+    assert len(renderer.calls) == 3
+
+    # 送信済みの結果は再送信しない
+    database = run_morning(database, log_path, sender, renderer)
+    assert len(sender.pushes) == 1
+    assert len(renderer.calls) == 3
+
+def test_text_is_not_resent_when_delivery_log_is_lost(morning):
+    database, log_path = morning
+    sender = Sender()
+    renderer = Renderer(lambda attempt: attempt == 2)
+
+    database = run_morning(database, log_path, sender, renderer)
+    os.remove(log_path)
+    database = run_morning(database, log_path, sender, renderer)
+
+    assert database['results']['result_1']['sent'] is True
+    assert len(sender.pushes) == 1
+
+def test_failed_text_push_is_resent_with_same_retry_key(morning):
+    database, log_path = morning
+    failing = Sender(fail={1})
+    renderer = Renderer(lambda attempt: True)
+
+    database = run_morning(database, log_path, failing, renderer)
+    assert database['results']['result_1']['sent'] is False
+    assert 'text_delivered' not in database['results']['result_1']
+    assert renderer.calls == []
+
+    sender = Sender()
+    database = run_morning(database, log_path, sender, renderer)
+    assert database['results']['result_1']['sent'] is True
+    assert len(sender.pushes) == 1
+    assert len(renderer.calls) == 1
+
+@pytest.mark.parametrize('server_url, available, in_push', [
+    ('https://example.app', True, True),
+    ('https://example.app', False, False),
+    ('http://localhost:3000', True, False),
+])
+def test_pre_generated_image_is_pushed_only_over_https(morning, monkeypatch, server_url, available, in_push):
+    database, log_path = morning
+    database['results']['result_1'] = {**RESULT, 'mindmap_image_path': 'mindmap_abc.svg'}
+    monkeypatch.setattr(send_notifications, 'SERVER_URL', server_url)
+    monkeypatch.setattr(send_notifications, 'mindmap_image_available', lambda image_url: available)
+    pushes = []
+    renderer = Renderer(lambda attempt: True)
+
+    def sender(user_id, messages, retry_key=None):
+        pushes.append([message['type'] for message in messages])
+        return True
+
+    database = run_morning(database, log_path, sender, renderer)
+
+    assert database['results']['result_1']['sent'] is True
+    assert pushes == [['text', 'text', 'template'] + (['image'] if in_push else [])]
+    # 同じプッシュで送れない場合は、APIを呼び出してサーバーから送信する
+    assert len(renderer.calls) == (0 if in_push else 1)
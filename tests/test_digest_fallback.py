@@ -0,0 +1,62 @@
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'scripts'))
+
+import cascade
+import process_ideas
+from cascade import CascadeStats
+from governor import NightGovernor, prioritize
+from records import RecordStore
+
+# ダイジェストモードで応答を分けられなかった場合のテスト
+# 失敗したユーザーの残りのアイデアはアイデアごとに処理し、失敗した呼び出しはダイジェストの見積もりに含めないことを確認する
+
+class Response:
+    def __init__(self, content):
+        self.choices = [type('Choice', (), {'message': {'content': content}})()]
+        self.usage = {'total_tokens': 100}
+
+# 見出しのない（分けられない）応答を返すOpenAI APIの代わり
+class ChatCompletion:
+    requests = []
+
+    @classmethod
+    def create(cls, model, messages, **kwargs):
+        cls.requests.append(messages[-1]['content'])
+        return Response('見出しのない応答')
+
+@pytest.fixture
+def store(monkeypatch):
+    ChatCompletion.requests = []
+    monkeypatch.setattr(cascade, 'CASCADE_ENABLED', False)
+    monkeypatch.setattr(process_ideas, 'get_openai', lambda: type('OpenAI', (), {'ChatCompletion': ChatCompletion}))
+    ideas = {
+        f"idea_20250412_{i:03d}": {
+            'user_id': f"U{i % 2}",
+            'content': f"アイデア{i}",
+            'created_at': f"2025-04-12T10:00:{i:02d}.000Z",
+            'processed': False,
+        }
+        for i in range(7)
+    }
+    return RecordStore.from_dict({'users': {}, 'ideas': ideas, 'results': {}})
+
+def test_failed_digest_falls_back_to_per_idea_for_the_night(store):
+    governor = NightGovernor(digest=True)
+    queue = prioritize(store.unprocessed_ideas())
+
+    process_ideas.process_digests(store, queue, governor, CascadeStats())
+
+    # ダイジェストはユーザーごとに1回だけ試し、残りはブラッシュアップ・マインドマップを1件ずつ生成する
+    digests = [request for request in ChatCompletion.requests if request.startswith('以下の') and 'それぞれブラッシュアップ' in request]
+    assert len(digests) == 2
+    assert len(ChatCompletion.requests) == 2 + 7 * 2
+    assert store.unprocessed_ideas() == []
+    assert all(result.get('digest_id') is None for result in store.results.values())
+
+    # 失敗した呼び出しは使ったトークン数に含めるが、ダイジェストの平均には含めない
+    assert governor.average_call('digest', governor.primary_model) is None
+    assert governor.calls[f"digest_failed:{governor.primary_model}"]['count'] == 7
+    assert governor.spent_tokens == 100 * len(ChatCompletion.requests)
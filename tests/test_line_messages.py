@@ -0,0 +1,102 @@
+import os
+import sys
+import random
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'scripts'))
+
+from line_messages import (
+    MAX_TEXT_LENGTH,
+    MAX_MESSAGES_PER_REQUEST,
+    text_length,
+    split_text,
+    build_text_messages,
+    pack_messages,
+)
+
+# LINEメッセージの分割・まとめ送信のプロパティテスト
+# 日本語・絵文字・改行の多いランダムな文章で、長さの上限と内容が失われないことを確認する
+
+# ランダムな文章の材料（絵文字はサロゲートペア・結合文字を含む）
+FRAGMENTS = [
+    'あいうえおかきくけこ', 'アイデアをブラッシュアップします', '犯罪発生予測マップ', '申請書を自動で記入',
+    '。', '、', '！', '？', '「', '」', '（', '）', '『', '』', ' ', '　', ',', '.', '!', '?',
+    'LINE', 'GitHub Actions', 'abc def',
+    '😀', '🎉', '👨‍👩‍👧‍👦', '🇯🇵', '❤️', '𠮷野家',
+    '\n', '\n', '\n\n', '\n\n\n',
+    '- ', '* ', '## ',
+]
+
+CASES = 200
+
+def random_text(rng, max_fragments):
+    return ''.join(rng.choice(FRAGMENTS) for _ in range(rng.randint(0, max_fragments)))
+
+# 分割された部分を元の文章に当てはめ、分割位置の改行以外が失われていないことを確認
+def assert_content_preserved(text, parts):
+    position = 0
+    for part in parts:
+        while position < len(text) and text[position] == '\n' and not text.startswith(part, position):
+            position += 1
+        assert text.startswith(part, position), f"part not found at {position}: {part[:20]!r}"
+        position += len(part)
+    assert text[position:].strip('\n') == ''
+
+@pytest.mark.parametrize('seed', range(CASES))
+def test_split_text_respects_limit_and_keeps_content(seed):
+    rng = random.Random(seed)
+    text = random_text(rng, 400)
+    max_length = rng.randint(2, 300)
+    first_max_length = rng.choice([None, rng.randint(2, max_length)])
+
+    parts = split_text(text, max_length, first_max_length)
+
+    assert parts
+    for i, part in enumerate(parts):
+        limit = first_max_length if i == 0 and first_max_length is not None else max_length
+        assert text_length(part) <= limit
+    assert_content_preserved(text, parts)
+
+@pytest.mark.parametrize('seed', range(CASES))
+def test_build_text_messages_fits_line_limit(seed):
+    rng = random.Random(seed)
+    body = random_text(rng, rng.choice([50, 3000, 8000]))
+    label = rng.choice(['ブラッシュアップ結果', 'マインドマップ', 'アイデア 1/3'])
+    prefix = rng.choice(['', '元のアイデア: 申請書\n\n', '😀' * 10 + '\n'])
+
+    messages = build_text_messages(label, body, prefix=prefix)
+
+    for message in messages:
+        assert message['type'] == 'text'
+        assert text_length(message['text']) <= MAX_TEXT_LENGTH
+
+    if len(messages) == 1:
+        assert messages[0]['text'] == f"{prefix}【{label}】\n{body}"
+        return
+
+    # 見出しを除いた本文が元の本文と一致する
+    total = len(messages)
+    parts = []
+    for i, message in enumerate(messages, 1):
+        header = f"{prefix if i == 1 else ''}【{label} ({i}/{total})】\n"
+        assert message['text'].startswith(header)
+        parts.append(message['text'][len(header):])
+    assert_content_preserved(body, parts)
+
+def test_build_text_messages_counts_utf16_units():
+    # 絵文字はUTF-16で2単位のため、文字数では上限内でも分割が必要
+    body = '😀' * 3000
+    messages = build_text_messages('絵文字', body)
+    assert len(messages) == 2
+    assert all(text_length(message['text']) <= MAX_TEXT_LENGTH for message in messages)
+    assert ''.join(message['text'].split('\n', 1)[1] for message in messages) == body
+
+@pytest.mark.parametrize('count', [0, 1, 4, 5, 6, 10, 11, 23])
+def test_pack_messages_batches_in_order(count):
+    messages = [{'type': 'text', 'text': str(i)} for i in range(count)]
+
+    batches = pack_messages(messages)
+
+    assert all(0 < len(batch) <= MAX_MESSAGES_PER_REQUEST for batch in batches)
+    assert [message for batch in batches for message in batch] == messages
+    assert len(batches) == -(-count // MAX_MESSAGES_PER_REQUEST)
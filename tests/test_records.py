@@ -0,0 +1,187 @@
+import os
+import sys
+import json
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'scripts'))
+
+from records import Idea, Result, RecordStore, format_timestamp, read_local_store
+
+# レコード層の読み込み・保存のテスト
+# 読み込んでから変更せずに保存した場合は、null・キーがない場合・型の違う値・キーの並び順も含めて元のJSONに戻ることを確認する
+
+DATABASE_PATH = os.path.join(os.path.dirname(__file__), '..', 'data', 'database.json')
+
+IDEA = {
+    'user_id': 'U0123456789abcdef0123456789abcdef',
+    'content': 'ラインで自動で申請書を記入できるアプリをつくりたい',
+    'created_at': '2025-04-06T11:54:05.972Z',
+    'processed': False,
+}
+
+RESULT = {
+    'idea_id': 'idea_20250406_001',
+    'enhanced_content': 'ブラッシュアップ',
+    'mindmap_content': '* アイデア',
+    'created_at': '2025-04-06T21:15:15.098764',
+    'sent': False,
+}
+
+def without(data, key):
+    return {name: value for name, value in data.items() if name != key}
+
+def replaced(data, **values):
+    return {name: values.get(name, value) for name, value in data.items()}
+
+IDEA_CASES = {
+    'canonical': IDEA,
+    'null content': replaced(IDEA, content=None),
+    'null user_id': replaced(IDEA, user_id=None),
+    'int user_id': replaced(IDEA, user_id=12345),
+    'missing user_id': without(IDEA, 'user_id'),
+    'missing processed': without(IDEA, 'processed'),
+    'int processed': replaced(IDEA, processed=1),
+    'null created_at': replaced(IDEA, created_at=None),
+    'missing created_at': without(IDEA, 'created_at'),
+    'bogus created_at': replaced(IDEA, created_at='yesterday'),
+    'created_at without millis': replaced(IDEA, created_at='2025-04-06T11:54:05Z'),
+    'naive created_at': replaced(IDEA, created_at='2025-04-06T21:15:15.098764'),
+    'offset created_at': replaced(IDEA, created_at='2025-04-06T11:54:05.972+09:00'),
+    'extra keys': {**IDEA, 'priority': 3, 'tags': ['a', 'b'], 'note': None},
+    'key order': {key: IDEA[key] for key in ('processed', 'content', 'user_id', 'created_at')},
+    'extra key first': {'source': 'line', **IDEA},
+}
+
+RESULT_CASES = {
+    'canonical': RESULT,
+    'null mindmap_content': replaced(RESULT, mindmap_content=None),
+    'missing enhanced_content': without(RESULT, 'enhanced_content'),
+    'missing sent': without(RESULT, 'sent'),
+    'utc created_at': replaced(RESULT, created_at='2025-04-10T15:47:19.132Z'),
+    'created_at without micros': replaced(RESULT, created_at='2025-04-06T21:15:15'),
+    'legacy keys': {
+        'idea_id': RESULT['idea_id'], 'analysis': '分析', 'evaluation': None,
+        **without(RESULT, 'idea_id'),
+    },
+    'image path': {**RESULT, 'mindmap_image_path': 'mindmap_abc.png', 'mindmap_image_generated': True},
+}
+
+# JSONの文字列として比較し、キーの並び順と値の型も一致することを確認する
+def dumps(data):
+    return json.dumps(data, ensure_ascii=False, indent=2)
+
+def load_both(database):
+    text = dumps(database)
+    return [RecordStore.from_json(text), RecordStore.from_dict(json.loads(text))]
+
+@pytest.mark.parametrize('name', IDEA_CASES)
+def test_idea_round_trip(name):
+    database = {'users': {}, 'ideas': {'idea_20250406_001': IDEA_CASES[name]}, 'results': {}}
+    for store in load_both(database):
+        assert dumps(store.to_dict()) == dumps(database)
+
+@pytest.mark.parametrize('name', RESULT_CASES)
+def test_result_round_trip(name):
+    database = {'users': {}, 'ideas': {'idea_20250406_001': IDEA}, 'results': {'result_20250406_001': RESULT_CASES[name]}}
+    for store in load_both(database):
+        assert dumps(store.to_dict()) == dumps(database)
+
+def test_round_trip_after_reading_records():
+    ideas = {f"idea_20250406_{i:03d}": case for i, case in enumerate(IDEA_CASES.values())}
+    results = {f"result_20250406_{i:03d}": case for i, case in enumerate(RESULT_CASES.values())}
+    database = {'users': {'U1': {'created_at': IDEA['created_at']}}, 'ideas': ideas, 'results': results, 'version': 2}
+    for store in load_both(database):
+        # 取得してレコードに変換しても、変更しなければ元のとおりに保存される
+        for idea in store.ideas.values():
+            assert isinstance(idea, Idea)
+        for result in store.results.values():
+            assert isinstance(result, Result)
+        assert dumps(store.to_dict()) == dumps(database)
+
+def test_real_database_round_trip():
+    with open(DATABASE_PATH, 'r', encoding='utf-8') as f:
+        text = f.read()
+    database = json.loads(text)
+    for store in load_both(database):
+        assert dumps(store.to_dict()) == dumps(database)
+
+def test_absent_and_null_fields_read_as_defaults():
+    database = {'ideas': {
+        'idea_1': replaced(IDEA, content=None),
+        'idea_2': without(IDEA, 'processed'),
+        'idea_3': replaced(IDEA, user_id=12345),
+    }}
+    store = RecordStore.from_json(dumps(database))
+    assert store.ideas['idea_1'].content == ''
+    assert store.ideas['idea_2'].processed is False
+    assert store.ideas['idea_3'].user_id == '12345'
+    assert [idea.idea_id for idea in store.unprocessed_ideas()] == ['idea_1', 'idea_2', 'idea_3']
+
+def test_changed_fields_are_saved():
+    database = {'ideas': {
+        'idea_1': IDEA,
+        'idea_2': without(IDEA, 'processed'),
+        'idea_3': replaced(IDEA, content=None),
+    }, 'results': {'result_1': RESULT}}
+    store = RecordStore.from_json(dumps(database))
+    for idea in store.unprocessed_ideas():
+        idea.processed = True
+    store.ideas['idea_3'].content = '書き換えた内容'
+    result = store.results['result_1']
+    result.sent = True
+    result.set('mindmap_image_path', 'mindmap_abc.png')
+
+    saved = store.to_dict()
+    assert saved['ideas']['idea_1'] == {**IDEA, 'processed': True}
+    # キーがなかったフィールドも、変更した場合は保存される
+    assert saved['ideas']['idea_2'] == {**without(IDEA, 'processed'), 'processed': True}
+    assert saved['ideas']['idea_3'] == {**IDEA, 'content': '書き換えた内容', 'processed': True}
+    assert saved['results']['result_1'] == {**RESULT, 'sent': True, 'mindmap_image_path': 'mindmap_abc.png'}
+    assert store.unprocessed_ideas() == []
+    assert store.unsent_results() == []
+
+def test_records_are_converted_once():
+    store = RecordStore.from_json(dumps({'ideas': {'idea_1': IDEA}, 'results': {'result_1': RESULT}}))
+    # 全件の走査では変換したレコードを保持しない
+    assert [idea_id for idea_id, _ in store.ideas.scan()] == ['idea_1']
+    assert type(store.ideas.rows['idea_1']) is int
+    idea = store.ideas['idea_1']
+    assert store.ideas.get('idea_1') is idea
+    assert store.unprocessed_ideas() == [idea]
+    assert store.ideas.get('idea_2') is None
+
+def test_result_shares_idea_id_and_user_ids_are_interned():
+    user_id = ''.join(['U', '0' * 32])
+    database = {
+        'ideas': {
+            'idea_20250406_001': replaced(IDEA, user_id=user_id),
+            'idea_20250406_002': {**replaced(IDEA, user_id=''.join(['U', '0' * 32])), 'note': 'x'},
+        },
+        'results': {'result_20250406_001': RESULT},
+    }
+    for store in load_both(database):
+        first, second = store.unprocessed_ideas()
+        assert first.user_id is second.user_id
+        assert store.results['result_20250406_001'].idea_id is first.idea_id
+
+def test_add_result():
+    store = RecordStore.from_json(dumps({'ideas': {'idea_20250406_001': IDEA}}))
+    idea = store.ideas['idea_20250406_001']
+    result = store.add_result(idea, '拡張', '* マップ')
+    assert store.results['result_20250406_001'] is result
+    assert store.unsent_results() == [result]
+
+    saved = store.to_dict()['results']['result_20250406_001']
+    assert list(saved) == ['idea_id', 'enhanced_content', 'mindmap_content', 'created_at', 'sent']
+    assert saved['created_at'] == format_timestamp(result.created_at, result.created_at_format)
+    assert saved['sent'] is False
+
+def test_read_local_store(tmp_path):
+    assert read_local_store(str(tmp_path / 'missing.json')) is None
+    broken = tmp_path / 'broken.json'
+    broken.write_text('{', encoding='utf-8')
+    assert read_local_store(str(broken)) is None
+
+    path = tmp_path / 'database.json'
+    path.write_text(dumps({'ideas': {'idea_1': IDEA}}), encoding='utf-8')
+    assert [idea.idea_id for idea in read_local_store(str(path)).unprocessed_ideas()] == ['idea_1']